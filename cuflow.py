@@ -1,16 +1,24 @@
 from collections import defaultdict
+import heapq
 import re
 import math
 import csv
+import threading
 
 from PIL import Image
+import shapely
 import shapely.geometry as sg
 import shapely.affinity as sa
 import shapely.ops as so
+from shapely.strtree import STRtree
 import math
 
 import gerber
 from excellon import excellon
+from pour import pour, grid
+import pipeline
+import raster
+from pipeline import Job
 import hershey
 import hex
 
@@ -34,60 +42,293 @@ def pretty_parts(nms):
             nn = nn[1:]
     return ",".join(ni)
 
+def pieces_of(g):
+    # The non-empty members of a geometry, or the geometry itself
+    return [p for p in getattr(g, 'geoms', [g]) if not p.is_empty]
+
+def gather(gg):
+    # Gather disjoint geometries without running an overlay on them
+    if len(gg) == 1:
+        return gg[0]
+    if gg and all(isinstance(g, sg.Polygon) for g in gg):
+        return sg.MultiPolygon(gg)
+    return sg.GeometryCollection(gg)
+
+def clipped(polys, size):
+    # The union of polys, one tile at a time. The pieces from adjacent
+    # tiles share their edges exactly, so together they draw the union.
+    if not polys:
+        return
+    tree = STRtree(polys)
+    for row in grid(shapely.total_bounds(polys), size):
+        for t in row:
+            box = sg.box(*t)
+            hits = tree.query(box, predicate = "intersects")
+            if len(hits):
+                yield shapely.union_all(shapely.intersection(
+                    [polys[i] for i in sorted(hits)], box))
+
+def moved(shape, xy, angle):
+    # Aperture shape moved by -xy, then rotated by -angle degrees
+    (x0, y0) = xy
+    (c, s) = (math.cos(math.radians(angle)), math.sin(math.radians(angle)))
+    def pt(p):
+        (x, y) = (p[0] - x0, p[1] - y0)
+        return (c * x + s * y, c * y - s * x)
+    (kind, *args) = shape
+    if kind == "circle":
+        (p, d) = args
+        return (kind, pt(p), d)
+    if kind == "rectangle":
+        (p, w, h, a) = args
+        return (kind, pt(p), w, h, round((a - angle) % 180, 6) % 180)
+    (pp, w) = args
+    return (kind, [pt(p) for p in pp], w)
+
+def signature(v):
+    # v with its floats rounded to the Gerber resolution, for comparison
+    if isinstance(v, (list, tuple)):
+        return tuple(signature(e) for e in v)
+    if isinstance(v, float):
+        return round(v, 4)
+    return v
+
+def netkey(nm):
+    # Board.fill_any() names its pours with a list of nets
+    return tuple(nm) if isinstance(nm, list) else nm
+
 class Layer:
+    tile = 10.0     # mm, grid used to index the pieces of the union
+
     def __init__(self, desc):
-        self.polys = []
         self.desc = desc
         self.connected = []
-        self.p = None
+        self.part = None                # Part being placed, see Board.placing()
+        self.lock = threading.Lock()    # save() jobs may preview at once
+        self.polys = []
 
-    def add(self, o, nm = None):
-        self.polys.append((nm, o.simplify(0.001, preserve_topology=False)))
+    @property
+    def polys(self):
+        return self._polys
+
+    @polys.setter
+    def polys(self, pp):
+        self._polys = list(pp)
+        self.pending = [o for (_, o) in self._polys]
+        self.pieces = {}                # disjoint parts of the union
+        self.tiles = defaultdict(set)   # tile -> keys of pieces touching it
+        self.serial = 0
+        self.p = None
+        self.tree = None
+        self.bynet = defaultdict(list)  # name -> [(position in polys, poly)]
+        self.net_union = {}
+        self.except_union = {}
+        self.shapes = {}                # position in polys -> aperture shape
+        self.owner = {}                 # position in polys -> Part that placed it
+        for (i, (nm, o)) in enumerate(self._polys):
+            self.bynet[netkey(nm)].append((i, o))
+
+    def add(self, o, nm = None, shape = None):
+        # shape is how the Gerber can draw o with an aperture, e.g.
+        # ("circle", xy, d) or ("track", path, width)
+        o = o.simplify(0.001, preserve_topology=False)
+        self._polys.append((nm, o))
+        if shape is not None:
+            self.shapes[len(self._polys) - 1] = shape
+        if self.part is not None:
+            self.owner[len(self._polys) - 1] = self.part
+        self.pending.append(o)
         self.p = None
+        self.tree = None
+        k = netkey(nm)
+        self.bynet[k].append((len(self._polys) - 1, o))
+        self.net_union.pop(k, None)
+        self.except_union = {ex: u for (ex, u) in self.except_union.items() if k in ex}
+
+    def net(self, nm):
+        # Union of the polys named nm
+        k = netkey(nm)
+        if k not in self.net_union:
+            self.net_union[k] = so.unary_union([o for (_, o) in self.bynet.get(k, [])])
+        return self.net_union[k]
+
+    def excluding(self, names):
+        # Union of the polys whose name is not in names. The groups are
+        # merged back into add() order, so the result matches a plain scan.
+        ex = frozenset(netkey(nm) for nm in names)
+        if ex not in self.except_union:
+            groups = [g for (k, g) in self.bynet.items() if k not in ex]
+            self.except_union[ex] = so.unary_union(
+                [o for (_, o) in heapq.merge(*groups, key = lambda e: e[0])])
+        return self.except_union[ex]
+
+    def index(self):
+        # STRtree over the polys, rebuilt on first use after a change
+        if self.tree is None:
+            self.tree = STRtree([o for (_, o) in self._polys])
+        return self.tree
+
+    def query(self, region):
+        # The (name, poly) items that intersect region
+        hits = self.index().query(region, predicate = "intersects")
+        return [self._polys[i] for i in sorted(hits)]
+
+    def at(self, xy):
+        # The (name, poly) items under point xy
+        return self.query(sg.Point(xy))
+
+    def nearest(self, xy):
+        # The (name, poly) item closest to point xy, or None
+        if not self._polys:
+            return None
+        return self._polys[self.index().nearest(sg.Point(xy))]
+
+    def cells(self, g):
+        (x0, y0, x1, y1) = g.bounds
+        t = self.tile
+        return [(i, j)
+                for i in range(math.floor(x0 / t), math.floor(x1 / t) + 1)
+                for j in range(math.floor(y0 / t), math.floor(y1 / t) + 1)]
 
     def preview(self):
-        if self.p is None:
-            self.p = so.unary_union([p for (_, p) in self.polys])
-        return self.p
+        # New polys are unioned with only those pieces that share a tile
+        # with them, the rest of the cached union is reused as-is.
+        with self.lock:
+            if self.p is None:
+                if self.pending:
+                    fresh = pieces_of(so.unary_union(self.pending))
+                    self.pending = []
+                    touched = set()
+                    for g in fresh:
+                        for c in self.cells(g):
+                            touched |= self.tiles.get(c, set())
+                    if touched:
+                        old = [self.unfile(k) for k in touched]
+                        fresh = pieces_of(so.unary_union(old + fresh))
+                    [self.file(g) for g in fresh]
+                self.p = gather(list(self.pieces.values()))
+            return self.p
+
+    def file(self, g):
+        self.serial += 1
+        self.pieces[self.serial] = g
+        for c in self.cells(g):
+            self.tiles[c].add(self.serial)
+
+    def unfile(self, k):
+        g = self.pieces.pop(k)
+        for c in self.cells(g):
+            self.tiles[c].discard(k)
+        return g
 
     def paint(self, bg, include, r):
         # Return the intersection of bg with the current polylist
         # touching the included, avoiding the others by distance r
-        ingrp = so.unary_union([bg] + [o for (nm, o) in self.polys if nm == include])
-        exgrp = so.unary_union([o for (nm, o) in self.polys if nm != include])
-        self.powered = so.unary_union(ingrp).difference(exgrp.buffer(r))
+        ingrp = so.unary_union([bg, self.net(include)])
+        exgrp = self.excluding([include])
+        self.powered = pour(so.unary_union(ingrp), exgrp, r)
         return exgrp.union(self.powered)
 
     def fill(self, bg, include, d):
         self.polys = [('filled', self.paint(bg, include, d))]
         
-    def save(self, f):
-        surface = self.preview()
-        g = gerber.Gerber(f, self.desc)
-        def renderpoly(g, po):
-            if po.is_empty:
-                return
-            if isinstance(po, (sg.MultiPolygon, sg.GeometryCollection)):
-                [renderpoly(g, p) for p in po.geoms]
-                return
-            if not isinstance(po, sg.Polygon):
-                return
-            # Subdivide a poly if it has holes
-            if len(po.interiors) == 0:
-                g.poly(po.exterior.coords)
+    def apertures(self):
+        # Split the polys into aperture shapes and the leftover polys.
+        # Rectangles are recognised even when added without a shape.
+        # Shapes are returned as (owning Part or None, shape).
+        shapes = []
+        rest = []
+        for (i, (_, o)) in enumerate(self._polys):
+            s = self.shapes.get(i)
+            if s is None and isinstance(o, sg.Polygon) and not o.interiors:
+                r = gerber.rectangle(o.exterior.coords)
+                if r is not None:
+                    s = ("rectangle", ) + r
+            if s is None:
+                rest.append(o)
             else:
-                x0 = min([x for (x, y) in po.exterior.coords])
-                x1 = max([x for (x, y) in po.exterior.coords])
-                y0 = min([y for (x, y) in po.exterior.coords])
-                y1 = max([y for (x, y) in po.exterior.coords])
-                xm = (x0 + x1) / 2
-                eps = 0.000
-                renderpoly(g, po.intersection(sg.box(x0, y0, xm + eps, y1)))
-                renderpoly(g, po.intersection(sg.box(xm - eps, y0, x1, y1)))
-
-        renderpoly(g, surface)
+                shapes.append((self.owner.get(i), s))
+        return (shapes, rest)
+
+    def blocks(self, shapes):
+        # Find parts whose shapes are the same once moved back from the
+        # part's center and direction. Return the shapes of the others,
+        # and the repeats as [[(xy, angle, shapes in the part's frame)]].
+        single = [s for (p, s) in shapes if p is None]
+        byowner = defaultdict(list)
+        for (p, s) in shapes:
+            if p is not None:
+                byowner[p].append(s)
+        placed = defaultdict(list)
+        for (p, ss) in byowner.items():
+            (xy, angle) = (p.center.xy, -p.center.dir % 360)
+            local = [moved(s, xy, angle) for s in ss]
+            placed[signature(local)].append((xy, angle, local, ss))
+        repeats = []
+        for group in placed.values():
+            if len(group) > 1:
+                repeats.append([(xy, angle, local) for (xy, angle, local, _) in group])
+            else:
+                single += group[0][3]
+        return (single, repeats)
+
+    def save(self, f, stream = None):
+        g = gerber.Gerber(f, self.desc)
+        self.render(g, stream)
         g.finish()
 
+    def render(self, g, stream = None, blocks = True):
+        # Write the layer to Gerber g. Flashes and tracks are drawn over
+        # regions for everything else. With stream set, the regions are
+        # unioned and written a tile of that size at a time, so only one
+        # tile's union is ever in memory. With blocks set, the shapes of
+        # a footprint placed more than once are written as a block
+        # aperture, flashed at each placement.
+        (shapes, rest) = self.apertures()
+        if blocks:
+            (single, repeats) = self.blocks(shapes)
+        else:
+            (single, repeats) = ([s for (_, s) in shapes], [])
+        if stream:
+            surfaces = clipped(rest, stream)
+        elif shapes:
+            surfaces = [so.unary_union(rest)]
+        else:
+            surfaces = [self.preview()]
+        def polygons(po):
+            if isinstance(po, (sg.MultiPolygon, sg.GeometryCollection)):
+                return sum([polygons(p) for p in po.geoms], [])
+            if isinstance(po, sg.Polygon) and not po.is_empty:
+                return [po]
+            return []
+        def renderpoly(g, po):
+            # Each polygon is a dark region with clear regions for its
+            # holes. A clear region erases everything drawn under it, so
+            # polygons go biggest first: anything sitting in a hole is
+            # smaller than the polygon around it, so is drawn later.
+            pp = polygons(po)
+            pp.sort(key = lambda p: -sg.Polygon(p.exterior).area)
+            for p in pp:
+                g.poly(shapely.get_coordinates(p.exterior))
+                if p.interiors:
+                    g.polarity("C")
+                    for h in p.interiors:
+                        g.poly(shapely.get_coordinates(h))
+                    g.polarity("D")
+
+        for surface in surfaces:
+            renderpoly(g, surface)
+        for (kind, *args) in single:
+            getattr(g, kind)(*args)
+        # Define the blocks unrotated, then flash them
+        codes = [g.block(group[0][2]) for group in repeats]
+        for (d, group) in zip(codes, repeats):
+            for (xy, angle, _) in group:
+                g.use(d)
+                g.rotation(angle)
+                g.flash(xy)
+        g.rotation(0)
+
     def povray(self, f, prefix = "polygon {", mask = None, invert = False):
         surface = self.preview()
         if invert:
@@ -136,14 +377,17 @@ class OutlineLayer:
         # Add po to the routed list
         self.routed.append(po)
 
-    def save(self, f):
+    def save(self, f, stream = None):
         g = gerber.Gerber(f, self.desc)
-        for ls in self.lines:
-            g.linestring(ls.coords)
-        for po in self.routed:
-            g.linestring(po.exterior.coords)
+        self.render(g)
         g.finish()
 
+    def render(self, g, stream = None, blocks = True):
+        # Outlines are small, so are never streamed or blocked
+        rings = self.lines + [po.exterior for po in self.routed]
+        (xy, index) = shapely.get_coordinates(rings, return_index = True)
+        g.linestrings(xy, index)
+
 class Turtle:
     def __repr__(self):
         return "<at (%.3f, %.3f) facing %.3f '%s'>" % (self.xy + (self.dir, self.name))
@@ -369,7 +613,7 @@ class Draw(Turtle):
         return self
 
     def mark(self):
-        self.board.layers['GTO'].add(sg.Point(self.xy).buffer(.2))
+        self.board.layers['GTO'].add(sg.Point(self.xy).buffer(.2), None, ("circle", self.xy, .4))
         mm = self.copy()
         mm.newpath()
         mm.forward(.3)
@@ -415,6 +659,9 @@ class Draw(Turtle):
         self.boundary = self.poly()
         self.board.layers['GML'].route(self.poly())
         self.pop()
+        a = self.copy().left(90).forward(l / 2).xy
+        b = self.copy().right(90).forward(l / 2).xy
+        self.board.slot(a, b, 2 * r)
 
     def thermal(self, d):
         for i in range(4):
@@ -458,13 +705,14 @@ class Draw(Turtle):
     def silk(self):
         g = sg.LineString(self.path).buffer(self.board.silk / 2)
         layer = {'GTL': 'GTO', 'GBL': 'GBO'}[self.layer]
-        self.board.layers[layer].add(g)
+        self.board.layers[layer].add(g, None, ("track", list(self.path), self.board.silk))
         return self
 
     def silko(self):
         g = sg.LinearRing(self.path).buffer(self.board.silk / 2)
         layer = {'GTL': 'GTO', 'GBL': 'GBO'}[self.layer]
-        self.board.layers[layer].add(g)
+        ring = list(self.path) + [self.path[0]]
+        self.board.layers[layer].add(g, None, ("track", ring, self.board.silk))
 
     def outline(self):
         g = sg.LinearRing(self.path)
@@ -476,7 +724,7 @@ class Draw(Turtle):
     def via(self, connect = None):
         g = sg.Point(self.xy).buffer(self.board.via / 2)
         for n in {'GTL', 'GL2', 'GL3', 'GBL'} - {connect}:
-            self.board.layers[n].add(g, connect)
+            self.board.layers[n].add(g, connect, ("circle", self.xy, self.board.via))
         if connect is not None:
             self.board.layers[connect].connected.append(g)
         self.board.drill(self.xy, self.board.via_hole)
@@ -495,7 +743,7 @@ class Draw(Turtle):
             ls = sg.LineString(self.path)
             self.length += ls.length
             g = ls.buffer(self.width / 2)
-            self.board.layers[self.layer].add(g, self.name)
+            self.board.layers[self.layer].add(g, self.name, ("track", list(self.path), self.width))
             self.newpath()
         return self
 
@@ -515,6 +763,8 @@ class Draw(Turtle):
         brd = self.board
 
         g1 = sg.LineString(self.path).buffer(buf)
+        for (a, b) in zip(self.path, self.path[1:]):
+            brd.slot(a, b, 2 * buf)
 
         g2 = sg.LinearRing(g1.exterior.coords)
         brd.layers['GML'].add(g2)
@@ -836,8 +1086,12 @@ class Board:
         self.silk = silk
         self.parts = defaultdict(list)
         self.holes = defaultdict(list)
+        self.slots = defaultdict(list)
+        self.drill_order = None     # reorders drill hits, e.g. excellon.shortest
         self.keepouts = []
         self.outline_polygon = None
+        self.derived_key = None
+        self.extra_exports = {}     # more save() outputs, name -> pipeline.Job
 
         self.c = trace + space # track spacing, used everywhere
 
@@ -865,6 +1119,12 @@ class Board:
             'GL3': 'G3L',
         }
 
+    def placing(self, part):
+        # Note part as the owner of what is added to the layers, until
+        # called again with None
+        for l in self.layers.values():
+            l.part = part
+
     def boundary(self, r = 0, corner_radius = 0):
         x0,y0 = (-r, -r)
         x1,y1 = self.size
@@ -903,11 +1163,15 @@ class Board:
             # self.layers['GTP'].add(sg.Point(xy).buffer(.2))
         self.keepouts.append(sg.Point(xy).buffer(inner / 2 + ko))
         if stencil_alignment:
-            self.layers['GTP'].add(sg.Point(xy).buffer(inner / 2))
+            self.layers['GTP'].add(sg.Point(xy).buffer(inner / 2), None, ("circle", xy, inner))
 
     def drill(self, xy, diam):
         self.holes[diam].append(xy)
 
+    def slot(self, xy0, xy1, width):
+        # A plated slot from xy0 to xy1, drilled as a G85 slot
+        self.slots[width].append((xy0, xy1))
+
     def annotate(self, x, y, s):
         self.layers['GTO'].add(hershey.ctext(x, y, s))
 
@@ -918,7 +1182,7 @@ class Board:
         return Drawf(self, xy, d)
 
     def fill(self, edge_clearance = 0.2):
-        ko = so.unary_union(self.keepouts)
+        ko = self.keepout()
         board_area = self.outline_polygon or sg.box(
             0, 0, self.size[0], self.size[1])
         g = board_area.buffer(-edge_clearance).difference(ko)
@@ -928,49 +1192,88 @@ class Board:
     def fill_any(self, layer, include):
         if isinstance(include, str):
             include = [include]
-        ko = so.unary_union(self.keepouts)
+        ko = self.keepout()
         g = self.body().buffer(-0.2).difference(ko)
         la = self.layers[layer]
 
         d = max(self.space, self.via_space)
-        notouch = so.unary_union([o for (nm, o) in la.polys if nm not in include])
-        self.layers[layer].add(
-            g.difference(notouch.buffer(d)), include
-        )
+        notouch = la.excluding(include)
+        self.layers[layer].add(pour(g, notouch, d), include)
 
     def addnet(self, a, b):
         self.nets.append(((a.part, a.name), (b.part, b.name)))
 
+    def derived(self):
+        # Cache of geometry derived from the outline, routed slots, holes
+        # and keepouts. It is emptied when any of those has changed.
+        gml = self.layers['GML']
+        key = (tuple(map(id, gml.lines)), tuple(map(id, gml.routed)),
+               tuple((d, len(xys)) for (d, xys) in self.holes.items()),
+               len(self.keepouts))
+        if key != self.derived_key:
+            self.derived_key = key
+            self.derived_src = (list(gml.lines), list(gml.routed))  # keeps the ids unique
+            self.derived_cache = {}
+        return self.derived_cache
+
+    def keepout(self):
+        # Union of the keepouts
+        c = self.derived()
+        if 'keepout' not in c:
+            c['keepout'] = so.unary_union(self.keepouts)
+        return c['keepout']
+
+    def cutouts(self):
+        # Holes big enough to be cut from the substrate, one union per size
+        c = self.derived()
+        if 'cutouts' not in c:
+            c['cutouts'] = [
+                so.unary_union([sg.Point(xy).buffer(d / 2) for xy in xys])
+                for d,xys in self.holes.items() if d > 0.3]
+        return c['cutouts']
+
     def body(self):
         # Return the board outline with holes and slots removed.
         # This is the shape of the resin subtrate.
-        gml = self.layers['GML'].lines
-        assert gml != [], "Missing board outline"
-        mask = sg.Polygon(gml[-1], gml[:-1])
-        routed = self.layers['GML'].routed
-        if routed:
-            mask = mask.difference(so.unary_union(routed))
-        for d,xys in self.holes.items():
-            if d > 0.3:
-                hlist = so.unary_union([sg.Point(xy).buffer(d / 2) for xy in xys])
+        c = self.derived()
+        if 'body' not in c:
+            gml = self.layers['GML'].lines
+            assert gml != [], "Missing board outline"
+            mask = sg.Polygon(gml[-1], gml[:-1])
+            routed = self.layers['GML'].routed
+            if routed:
+                mask = mask.difference(so.unary_union(routed))
+            for hlist in self.cutouts():
                 mask = mask.difference(hlist)
-        return mask
+            c['body'] = mask
+        return c['body']
 
     def substrate(self):
-        substrate = Layer(None)
-        gml = self.layers['GML'].lines
-        if gml == []:
-            return substrate
-        mask = sg.Polygon(gml[-1], gml[:-1])
-        routed = self.layers['GML'].routed
-        if routed:
-            mask = mask.difference(so.unary_union(routed))
-        for d,xys in self.holes.items():
-            if d > 0.3:
-                hlist = so.unary_union([sg.Point(xy).buffer(d / 2) for xy in xys])
-                mask = mask.difference(hlist)
-        substrate.add(mask)
-        return substrate
+        c = self.derived()
+        if 'substrate' not in c:
+            substrate = Layer(None)
+            if self.layers['GML'].lines != []:
+                substrate.add(self.body())
+            c['substrate'] = substrate
+        return c['substrate']
+
+    def pictures(self):
+        # The board's layers as (geometry, colour) for raster.render() and
+        # pyramid.Pyramid, in the colours of the view script
+        def geometry(id):
+            if id == 'TXT':
+                return ([sg.Point(xy).buffer(d / 2) for (d, xys) in self.holes.items() for xy in xys] +
+                        [sg.LineString(s).buffer(d / 2) for (d, ss) in self.slots.items() for s in ss])
+            l = self.layers[id]
+            if isinstance(l, OutlineLayer):
+                return [sg.LineString(r) for r in l.lines] + [po.exterior for po in l.routed]
+            return l.preview()
+        ids = [id for id in raster.colours if id in self.layers or id == 'TXT']
+        return [(geometry(id), raster.colours[id]) for id in ids]
+
+    def png(self, filename, ppmm = 25):
+        # Draw the board's layers to an image, at ppmm pixels per mm
+        raster.save(filename, self.pictures(), ppmm = ppmm)
 
     def drc(self):
         mask = self.substrate().preview()
@@ -980,40 +1283,73 @@ class Board:
                 print("Layer", l, "boundary error")
                 # self.layers["GTO"].add(lg.difference(mask).buffer(.1))
 
-    def save(self, basename):
-        # self.drc()
-        # self.check()
+    def exports(self, stream = None):
+        # The outputs of save(), as name -> pipeline.Job. Each job is run
+        # with the basename. Untagged jobs only run as dependencies.
+        # stream is the tile size for streaming Gerber export.
+        jobs = {}
+        def gerber_job(l, extension):
+            def run(basename):
+                with open(basename + "." + extension, "wt") as f:
+                    l.save(f, stream)
+            return run
+        def preview(l):
+            return lambda basename: l.preview()
         for (id, l) in self.layers.items():
             extension = self.layer_extensions.get(id, id)
-            with open(basename + "." + extension, "wt") as f:
-                l.save(f)
-        with open(basename + ".TXT", "wt") as f:
-            excellon(f, self.holes)
-
-        substrate = self.substrate()
-        mask = substrate.preview()
-        with open(basename + ".sub.pov", "wt") as f:
-            substrate.povray(f, "prism { linear_sweep linear_spline 0 1")
-        with open(basename + ".gto.pov", "wt") as f:
-            self.layers['GTO'].povray(f, mask = mask)
-        with open(basename + ".gtl.pov", "wt") as f:
-            self.layers['GTL'].povray(f, mask = mask)
-        with open(basename + ".gts.pov", "wt") as f:
-            self.layers['GTS'].povray(f, mask = mask, invert = True)
+            if isinstance(l, Layer):
+                jobs["preview " + id] = Job(preview(l))
+            jobs[extension] = Job(gerber_job(l, extension), (), ("gerber",))
+
+        def drill(basename):
+            with open(basename + ".TXT", "wt") as f:
+                (before, after) = excellon(f, self.holes, None, self.slots, self.drill_order)
+            if self.drill_order is not None:
+                print("Drill travel %.0f mm, was %.0f mm" % (after, before))
+        jobs["TXT"] = Job(drill, (), ("drill",))
+
+        jobs["mask"] = Job(lambda basename: self.substrate().preview())
+        def pov(suffix, id, **kw):
+            def run(basename):
+                with open(basename + suffix, "wt") as f:
+                    self.layers[id].povray(f, mask = self.substrate().preview(), **kw)
+            return Job(run, ("mask", "preview " + id), ("pov",))
+        def substrate_pov(basename):
+            with open(basename + ".sub.pov", "wt") as f:
+                self.substrate().povray(f, "prism { linear_sweep linear_spline 0 1")
+        jobs["sub.pov"] = Job(substrate_pov, ("mask",), ("pov",))
+        jobs["gto.pov"] = pov(".gto.pov", 'GTO')
+        jobs["gtl.pov"] = pov(".gtl.pov", 'GTL')
+        jobs["gts.pov"] = pov(".gts.pov", 'GTS', invert = True)
         # Copper covered by top solder mask.  This is useful to render the
         # slight conformal rise of solder mask over traces separately from
         # exposed, surface-finished copper.
-        covered_copper = Layer(None)
-        covered_copper.add(
-            self.layers['GTL'].preview().difference(
-                self.layers['GTS'].preview()).intersection(mask))
-        with open(basename + ".gtl-covered.pov", "wt") as f:
-            covered_copper.povray(f, mask = mask)
-
-        return {
-            "bom": self.bom(basename),
-            "pnp": self.pnp(basename),
-        }
+        def covered_pov(basename):
+            mask = self.substrate().preview()
+            covered_copper = Layer(None)
+            covered_copper.add(
+                self.layers['GTL'].preview().difference(
+                    self.layers['GTS'].preview()).intersection(mask))
+            with open(basename + ".gtl-covered.pov", "wt") as f:
+                covered_copper.povray(f, mask = mask)
+        jobs["gtl-covered.pov"] = Job(
+            covered_pov, ("mask", "preview GTL", "preview GTS"), ("pov",))
+
+        jobs["bom"] = Job(self.bom, (), ("bom",))
+        jobs["pnp"] = Job(self.pnp, (), ("pnp",))
+        jobs.update(self.extra_exports)
+        return jobs
+
+    def save(self, basename, jobs = 1, only = None, stream = None):
+        # Write the outputs named in only (job names or the tags "gerber",
+        # "drill", "pov", "bom", "pnp"; default all of them) using jobs
+        # threads. Returns the BOM and PnP records that were generated.
+        # With stream set, Gerber layers are written a tile of that many
+        # mm at a time, without building the whole layer's union.
+        # self.drc()
+        # self.check()
+        results = pipeline.run(self.exports(stream), (basename,), only, jobs)
+        return {k: results[k] for k in ("bom", "pnp") if k in results}
 
     def pnp(self, fn):
         def flt(x):
@@ -1302,7 +1638,11 @@ class Part:
         self.pads  = []
         self.board = dc.board
         self.center = dc.copy()
-        self.place(dc)
+        self.board.placing(self)
+        try:
+            self.place(dc)
+        finally:
+            self.board.placing(None)
         if source is not None:
             self.source = source
 
@@ -1377,7 +1717,7 @@ class Part:
         (dc.w, dc.h) = (d, d)
         g = sg.Point(dc.xy).buffer(d / 2)
         for n in ('GTL', 'GTS', 'GTP'):
-            dc.board.layers[n].add(g)
+            dc.board.layers[n].add(g, None, ("circle", dc.xy, d))
         p = dc.copy()
         p.part = self.id
         self.pads.append(p)
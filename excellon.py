@@ -1,3 +1,7 @@
+import math
+
+import numpy as np
+
 preamble = """\
 M48
 FMAT,2
@@ -9,14 +13,94 @@ M71
 {1}M30
 """
 
-def excellon(f, holes):
-    tools = sorted(holes.keys())
+def travel(xys, start = (0, 0)):
+    # Length of the path from start through xys
+    p = np.array([start] + list(xys), dtype = float)
+    return float(np.hypot(*np.diff(p, axis = 0).T).sum())
+
+def nearest(xys, start = (0, 0)):
+    # xys in nearest-neighbour order from start
+    p = np.array(xys, dtype = float).reshape(-1, 2)
+    left = np.ones(len(p), bool)
+    here = np.array(start, dtype = float)
+    order = []
+    for _ in range(len(p)):
+        d = np.hypot(*(p - here).T)
+        d[~left] = np.inf
+        i = int(np.argmin(d))
+        order.append(i)
+        left[i] = False
+        here = p[i]
+    return [xys[i] for i in order]
+
+def two_opt(xys, start = (0, 0), passes = 20):
+    # Improve the path from start through xys by reversing stretches of
+    # it, until no reversal makes it shorter
+    p = np.array([start] + list(xys), dtype = float).reshape(-1, 2)
+    idx = np.arange(len(p))
+    n = len(p)
+    for _ in range(passes):
+        better = False
+        for i in range(1, n - 1):
+            # Reversing p[i..j] swaps edges (i-1, i) and (j, j+1) for
+            # (i-1, j) and (i, j+1). The last stretch has no (j, j+1).
+            a = p[idx[i - 1]]
+            b = p[idx[i]]
+            c = p[idx[i + 1:]]                  # candidates for j
+            d = np.vstack([p[idx[i + 2:]], [np.nan, np.nan]])
+            old = np.hypot(*(c - d).T)
+            new = np.hypot(*(b - d).T)
+            (old[-1], new[-1]) = (0, 0)
+            gain = (math.hypot(*(a - b)) + old) - (np.hypot(*(a - c).T) + new)
+            j = int(np.argmax(gain))
+            if gain[j] > 1e-9:
+                j += i + 1
+                idx[i:j + 1] = idx[i:j + 1][::-1].copy()
+                better = True
+        if not better:
+            break
+    return [xys[k - 1] for k in idx[1:]]
+
+def shortest(xys, start = (0, 0)):
+    # Nearest neighbour, then 2-opt: a short drill path through xys
+    return two_opt(nearest(xys, start), start)
+
+def excellon(f, holes, step = None, slots = None, order = None):
+    # step is (nx, ny, dx, dy) to repeat every hole on an nx by ny grid,
+    # dx and dy apart. Each row is one hit and an R repeat code.
+    # slots maps a width to a list of (xy0, xy1) slots, cut with G85.
+    # order reorders each tool's hits, e.g. order = shortest. It is called
+    # with the hits and where the drill starts.
+    # Returns the drill travel before and after reordering, in mm.
+    slots = slots or {}
+    tools = sorted(set(holes.keys()) | set(slots.keys()))
     p0 = "".join(["T%dC%.3f\n" % (i + 2, d) for (i, d) in enumerate(tools)])
     def number(n):
         i = int(round(n * 1000))
         return "%03d" % i
-    def hits(i, xys):
-        return (("T%d\n" % (i + 2)) + 
-                "".join(["X%sY%s\n" % (number(xy[0]), number(xy[1])) for xy in xys]))
-    p1 = "".join([hits(i, holes[t]) for (i, t) in enumerate(tools)])
+    if step is None:
+        (nx, ny, dx, dy) = (1, 1, 0, 0)
+    else:
+        (nx, ny, dx, dy) = step
+    repeat = "R%dX%s\n" % (nx - 1, number(dx)) if nx > 1 else ""
+    def xy(p, i, j):
+        return "X%sY%s" % (number(p[0] + i * dx), number(p[1] + j * dy))
+
+    p1 = ""
+    before = after = 0
+    (here, was) = ((0, 0), (0, 0))
+    for (t, d) in enumerate(tools):
+        xys = holes.get(d, [])
+        if xys:
+            before += travel(xys, was)
+            was = xys[-1]
+            if order is not None:
+                xys = order(xys, here)
+            after += travel(xys, here)
+            here = xys[-1]
+        p1 += "T%d\n" % (t + 2)
+        p1 += "".join([xy(p, 0, j) + "\n" + repeat for p in xys for j in range(ny)])
+        p1 += "".join([xy(a, i, j) + "G85" + xy(b, i, j) + "\n"
+                       for (a, b) in slots.get(d, []) for j in range(ny) for i in range(nx)])
     f.write(preamble.format(p0, p1))
+    return (before, after)
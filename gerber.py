@@ -1,3 +1,7 @@
+import math
+
+import numpy as np
+
 preamble = """\
 G04 Excamera Labs Gerber RS-274X export*
 G75*
@@ -13,34 +17,268 @@ G01*
 
 """
 
+# Rotated rectangle: width, height, rotation in degrees
+rectangle_macro = "%AMRECTR*\n21,1,$1,$2,0,0,$3*%\n"
+
+def arcs(pp, maxturn = math.radians(15), sagitta = 0.005):
+    # Split the path pp into straight segments and circular arcs.
+    # Returns (points, None) for lines to each of points and
+    # (xy, (center, ccw)) for an arc to xy. An arc is a run of at least
+    # three equal chords turning by the same small angle, as buffer()
+    # produces. Writing it as a true arc moves the outline by less than
+    # sagitta.
+    p = np.asarray(pp, dtype = float).reshape(-1, 2)
+    n = len(p)
+    if n < 4:
+        return [(p[1:], None)] if n > 1 else []
+    d = np.diff(p, axis = 0)                    # chord k is p[k] to p[k + 1]
+    length = np.hypot(d[:, 0], d[:, 1])
+    turn = np.arctan2(d[:-1, 0] * d[1:, 1] - d[:-1, 1] * d[1:, 0],
+                      (d[:-1] * d[1:]).sum(1))  # turn[k] is at p[k + 1]
+    # An arc can start at chord i if it turns gently, and the next two
+    # chords continue it
+    m = n - 3
+    tol = 1e-4 + 1e-3 * length[:m]
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        radius = length[:-1] / (2 * np.sin(np.abs(turn) / 2))
+        starts = np.flatnonzero(
+            (1e-9 < np.abs(turn[:m])) & (np.abs(turn[:m]) <= maxturn) &
+            (radius[:m] * (1 - np.cos(turn[:m] / 2)) < sagitta) &
+            (np.abs(length[1:m + 1] - length[:m]) < tol) &
+            (np.abs(length[2:m + 2] - length[:m]) < tol) &
+            (np.abs(turn[1:m + 1] - turn[:m]) < 1e-3))
+
+    def extent(i):
+        # How many chords from chord i on make one arc, looking at
+        # doubling spans so a run costs time linear in its length
+        tol = 1e-4 + 1e-3 * length[i]
+        m = 8
+        while True:
+            ok = ((np.abs(length[i + 1:i + 1 + m] - length[i]) < tol) &
+                  (np.abs(turn[i:i + m] - turn[i]) < 1e-3))
+            if not ok.all():
+                return 1 + int(np.argmin(ok))
+            if i + m >= n - 2:
+                return 1 + len(ok)
+            m *= 2
+
+    out = []
+    i = 0
+    k = 0
+    while k < len(starts):
+        s = starts[k]
+        c = extent(s)
+        if s > i:
+            out.append((p[i + 1:s + 1], None))
+        # Center is radius away from the first chord's midpoint, on the
+        # side it turns to
+        (x0, y0) = p[s]
+        (dx, dy) = d[s]
+        h = math.sqrt(max(0, radius[s] ** 2 - (length[s] / 2) ** 2)) / length[s]
+        t = 1 if turn[s] > 0 else -1
+        center = (x0 + dx / 2 - t * dy * h, y0 + dy / 2 + t * dx * h)
+        out.append((p[s + c], (center, turn[s] > 0)))
+        i = s + c
+        k = np.searchsorted(starts, i)
+    if i < n - 1:
+        out.append((p[i + 1:], None))
+    return out
+
+def rectangle(pp):
+    # If the closed ring pp is a rectangle, return its (center, w, h, angle)
+    if len(pp) != 5:
+        return None
+    ((x0, y0), (x1, y1), (x2, y2), (x3, y3), _) = pp
+    (ax, ay) = (x1 - x0, y1 - y0)
+    (bx, by) = (x2 - x1, y2 - y1)
+    (w, h) = (math.hypot(ax, ay), math.hypot(bx, by))
+    if min(w, h) < 1e-6:
+        return None
+    square = abs(ax * bx + ay * by) < 1e-6 * w * h
+    closes = abs(x3 - (x0 + bx)) < 1e-6 and abs(y3 - (y0 + by)) < 1e-6
+    if not (square and closes):
+        return None
+    center = ((x0 + x2) / 2, (y0 + y2) / 2)
+    return (center, w, h, math.degrees(math.atan2(ay, ax)) % 180)
+
 class Gerber:
     def __init__(self, f, desc):
         self.f = f
         self.f.write(preamble.format(desc))
+        self.apertures = {}
+        self.macros = set()
+        self.current = None
+        self.mode = "G01"
+        self.at = (None, None)  # current point, in file units
+        self.angle = 0          # rotation of flashes, %LR
+        self.next = 11          # next free D code
 
     def number(self, n):
         i = int(round(n * 10000))
         return "%07d" % i
-        
+
+    def coordinate(self, x, y):
+        # "XnnnYnnn" for the point x, y, leaving out a coordinate that
+        # repeats the current point's
+        (i, j) = (int(round(x * 10000)), int(round(y * 10000)))
+        (ci, cj) = self.at
+        self.at = (i, j)
+        return ("X%07d" % i if i != ci else "") + ("Y%07d" % j if j != cj else "")
+
+    def moves(self, pp, draw):
+        # Move to each point of pp, drawing (D01) where draw is true.
+        # Points are rounded in bulk, coordinates that repeat the current
+        # point's are left out, and the lot is written in one go. A move
+        # onto the current point is dropped, but not a draw: with a round
+        # aperture it still draws a dot.
+        a = np.rint(np.asarray(pp, dtype = float).reshape(-1, 2) * 10000).astype(np.int64)
+        if len(a) == 0:
+            return
+        draw = np.broadcast_to(draw, len(a))
+        changed = np.empty(a.shape, bool)
+        changed[0] = [a[0, 0] != self.at[0], a[0, 1] != self.at[1]]
+        changed[1:] = a[1:] != a[:-1]
+        (nx, ny) = changed.T
+        keep = draw | nx | ny
+        ops = np.where(draw[keep], "D01*\n", "D02*\n").tolist()
+        self.f.write("".join([
+            ("X%07d" % x if cx else "") + ("Y%07d" % y if cy else "") + op
+            for (x, y, cx, cy, op) in zip(a[keep, 0].tolist(), a[keep, 1].tolist(),
+                                          nx[keep].tolist(), ny[keep].tolist(), ops)]))
+        self.at = tuple(a[-1].tolist())
+
+    def paths(self, pp, index):
+        # Draw the paths in pp, where index gives the path of each point,
+        # as from shapely.get_coordinates(..., return_index = True)
+        self.interpolate("G01")
+        index = np.asarray(index)
+        draw = np.empty(len(index), bool)
+        draw[:1] = False
+        draw[1:] = index[1:] == index[:-1]
+        self.moves(pp, draw)
+
     def points(self, pp):
-        d = "D02"
-        for (x, y) in pp:
-            self.f.write("X" + self.number(x) + "Y" + self.number(y) + d + "*\n")
-            d = "D01"
+        pp = np.asarray(pp, dtype = float).reshape(-1, 2)
+        self.paths(pp, np.zeros(len(pp), int))
+
+    def interpolate(self, mode):
+        if mode != self.mode:
+            self.f.write(mode + "*\n")
+            self.mode = mode
+
+    def aperture(self, definition, macro = None):
+        # Select aperture definition, e.g. "C,0.500000", defining it first
+        if macro and macro not in self.macros:
+            self.f.write(macro)
+            self.macros.add(macro)
+        if definition not in self.apertures:
+            self.apertures[definition] = d = self.dcode()
+            self.f.write("%%ADD%d%s*%%\n" % (d, definition))
+        self.use(self.apertures[definition])
+
+    def dcode(self):
+        d = self.next
+        self.next += 1
+        return d
+
+    def use(self, d):
+        # Select aperture or block d
+        if d != self.current:
+            self.f.write("D%d*\n" % d)
+            self.current = d
+
+    def block(self, shapes):
+        # Define a block aperture drawing shapes, each a method name and
+        # its arguments, e.g. ("circle", (0, 0), 1.0). Return its D code.
+        d = self.dcode()
+        self.f.write("%%ABD%d*%%\n" % d)
+        (self.current, self.at, self.mode) = (None, (None, None), None)
+        for (kind, *args) in shapes:
+            getattr(self, kind)(*args)
+        self.f.write("%AB*%\n")
+        (self.current, self.at, self.mode) = (None, (None, None), None)
+        return d
+
+    def rotation(self, angle):
+        # Rotate later flashes by angle degrees, counterclockwise
+        if angle != self.angle:
+            self.f.write("%%LR%.6f*%%\n" % angle)
+            self.angle = angle
+
+    def flash(self, xy):
+        (x, y) = xy
+        self.f.write(self.coordinate(x, y) + "D03*\n")
 
     def rect(self, x0, y0, x1, y1):
         self.f.write("D10*\n")
+        self.current = 10
         self.points([(x0, y0), (x1, y0), (x1, y1), (x0, y1), (x0, y0)])
 
     def linestring(self, pp):
         self.f.write("D10*\n")
+        self.current = 10
+        self.points(pp)
+
+    def linestrings(self, pp, index):
+        if len(pp) == 0:
+            return
+        self.f.write("D10*\n")
+        self.current = 10
+        self.paths(pp, index)
+
+    def circle(self, xy, d):
+        self.aperture("C,%.6f" % d)
+        self.flash(xy)
+
+    def rectangle(self, xy, w, h, angle):
+        if min(angle % 90, -angle % 90) < 1e-6:
+            if round(angle / 90) % 2:
+                (w, h) = (h, w)
+            self.aperture("R,%.6fX%.6f" % (w, h))
+        else:
+            self.aperture("RECTR,%.6fX%.6fX%.6f" % (w, h, angle), rectangle_macro)
+        self.flash(xy)
+
+    def track(self, pp, w):
+        # Stroke the path pp with a round aperture of diameter w
+        self.aperture("C,%.6f" % w)
         self.points(pp)
 
+    def contour(self, pp):
+        pp = np.asarray(pp, dtype = float).reshape(-1, 2)
+        self.moves(pp[:1], False)
+        (x0, y0) = pp[0]
+        for (xy, arc) in arcs(pp):
+            if arc is None:
+                self.interpolate("G01")
+                self.moves(xy, True)
+                (x0, y0) = xy[-1]
+            else:
+                ((cx, cy), ccw) = arc
+                self.interpolate("G03" if ccw else "G02")
+                (x, y) = xy
+                self.f.write(self.coordinate(x, y) + "I" + self.number(cx - x0) + "J" + self.number(cy - y0) + "D01*\n")
+                (x0, y0) = (x, y)
+
     def poly(self, pp):
         self.f.write("G36*\n")
-        self.points(pp)
+        self.contour(pp)
+        self.interpolate("G01")
         self.f.write("G37*\n")
         self.f.write("\n")
 
+    def repeat(self, nx = 1, ny = 1, i = 0, j = 0):
+        # Open a step and repeat block of nx by ny copies, i and j apart.
+        # Called with no arguments, close the block.
+        if (nx, ny) == (1, 1):
+            self.f.write("%SR*%\n")
+        else:
+            self.f.write("%%SRX%dY%dI%.6fJ%.6f*%%\n" % (nx, ny, i, j))
+        self.at = (None, None)
+
+    def polarity(self, p):
+        # "D" for dark, "C" for clear
+        self.f.write("%%LP%s*%%\n" % p)
+
     def finish(self):
         self.f.write("M02*\n")
@@ -0,0 +1,473 @@
+"""Load Gerber and Excellon files as Shapely geometry.
+
+This reads back what gerber.Gerber and excellon.excellon write, and most
+other RS-274X: regions with arcs, standard and macro apertures, block
+apertures, step and repeat, and polarity. It is meant for checking a
+change to the exporters: load the old and new output and compare them.
+
+    python gerber_loader.py old/spiq_a spiq_a
+
+compares every layer and drill file of the two builds, and reports any
+layer whose image changed.
+"""
+
+import math
+import os
+import re
+import sys
+
+import shapely.affinity as sa
+import shapely.geometry as sg
+import shapely.ops as so
+
+def _arc(start, end, center, ccw, tolerance, full = False):
+    # The points after start along an arc to end, within tolerance
+    (x0, y0) = start
+    (x1, y1) = end
+    (cx, cy) = center
+    r0 = math.hypot(x0 - cx, y0 - cy)
+    r1 = math.hypot(x1 - cx, y1 - cy)
+    a0 = math.atan2(y0 - cy, x0 - cx)
+    a1 = math.atan2(y1 - cy, x1 - cx)
+    sweep = a1 - a0
+    if ccw:
+        sweep %= 2 * math.pi
+    else:
+        sweep = -(-sweep % (2 * math.pi))
+    if full and abs(sweep) < 1e-9:
+        sweep = 2 * math.pi if ccw else -2 * math.pi
+    r = max(r0, r1)
+    if r < tolerance:
+        return [end]
+    step = 2 * math.acos(max(-1, 1 - tolerance / r))
+    n = max(1, int(math.ceil(abs(sweep) / step)))
+    points = []
+    for k in range(1, n):
+        a = a0 + sweep * k / n
+        rk = r0 + (r1 - r0) * k / n
+        points.append((cx + rk * math.cos(a), cy + rk * math.sin(a)))
+    points.append(end)
+    return points
+
+def _evaluate(expression, variables):
+    # Aperture macro arithmetic: numbers, $n, + - x / and parentheses
+    expression = re.sub(r"\$(\d+)",
+                        lambda m: repr(variables.get(int(m.group(1)), 0.0)),
+                        expression)
+    expression = expression.replace("x", "*").replace("X", "*")
+    if not re.fullmatch(r"[-+*/().\deE ]*", expression):
+        raise ValueError("bad macro expression " + expression)
+    return float(eval(expression, {"__builtins__": {}}))
+
+def _macro(body, params, tolerance):
+    # The image of an aperture macro with parameters params
+    variables = {i + 1: v for (i, v) in enumerate(params)}
+    image = sg.Polygon()
+    for statement in body:
+        statement = statement.strip()
+        if not statement or statement.startswith("0"):
+            continue
+        m = re.fullmatch(r"\$(\d+)=(.*)", statement)
+        if m:
+            variables[int(m.group(1))] = _evaluate(m.group(2), variables)
+            continue
+        fields = statement.split(",")
+        code = int(fields[0])
+        v = [_evaluate(f, variables) for f in fields[1:]]
+        if code == 1:
+            (exposure, d, x, y) = v[:4]
+            rot = v[4] if len(v) > 4 else 0
+            g = sg.Point(x, y).buffer(d / 2, quad_segs = 32)
+        elif code in (2, 20):
+            (exposure, w, xs, ys, xe, ye, rot) = v[:7]
+            g = sg.LineString([(xs, ys), (xe, ye)]).buffer(
+                w / 2, cap_style = "flat")
+        elif code == 21:
+            (exposure, w, h, x, y, rot) = v[:6]
+            g = sg.box(x - w / 2, y - h / 2, x + w / 2, y + h / 2)
+        elif code == 4:
+            exposure = v[0]
+            n = int(v[1])
+            g = sg.Polygon([(v[2 + 2 * i], v[3 + 2 * i]) for i in range(n + 1)]).buffer(0)
+            rot = v[4 + 2 * n] if len(v) > 4 + 2 * n else 0
+        elif code == 5:
+            (exposure, n, x, y, d) = v[:5]
+            rot = v[5] if len(v) > 5 else 0
+            g = sg.Polygon([
+                (x + d / 2 * math.cos(2 * math.pi * i / n),
+                 y + d / 2 * math.sin(2 * math.pi * i / n))
+                for i in range(int(n))])
+        else:
+            raise ValueError("unsupported macro primitive %d" % code)
+        if rot:
+            g = sa.rotate(g, rot, origin = (0, 0))
+        image = image.union(g) if exposure else image.difference(g)
+    return image
+
+def _aperture(kind, params, macros, tolerance, scale = 1.0):
+    # The image of an aperture, centered on the origin
+    def hole(g, i):
+        if len(params) > i and params[i] > 0:
+            g = g.difference(sg.Point(0, 0).buffer(params[i] / 2, quad_segs = 32))
+        return g
+    if kind == "C":
+        return hole(sg.Point(0, 0).buffer(params[0] / 2, quad_segs = 32), 1)
+    if kind == "R":
+        (w, h) = params[:2]
+        return hole(sg.box(-w / 2, -h / 2, w / 2, h / 2), 2)
+    if kind == "O":
+        (w, h) = params[:2]
+        r = min(w, h) / 2
+        if w > h:
+            core = sg.LineString([(r - w / 2, 0), (w / 2 - r, 0)])
+        else:
+            core = sg.LineString([(0, r - h / 2), (0, h / 2 - r)])
+        return hole(core.buffer(r, quad_segs = 32), 2)
+    if kind == "P":
+        (d, n) = params[:2]
+        rot = params[2] if len(params) > 2 else 0
+        g = sg.Polygon([
+            (d / 2 * math.cos(math.radians(rot) + 2 * math.pi * i / n),
+             d / 2 * math.sin(math.radians(rot) + 2 * math.pi * i / n))
+            for i in range(int(n))])
+        return hole(g, 3)
+    if kind in macros:
+        g = _macro(macros[kind], params, tolerance)
+        return sa.scale(g, scale, scale, origin = (0, 0)) if scale != 1 else g
+    raise ValueError("unknown aperture " + kind)
+
+def _image(objects):
+    # Combine (geometry, dark) objects in order, a batch at a time
+    image = sg.Polygon()
+    batch = []
+    dark = True
+    for (g, d) in objects + [(None, not dark)]:
+        if d != dark or g is None:
+            u = so.unary_union(batch) if batch else sg.Polygon()
+            image = image.union(u) if dark else image.difference(u)
+            (batch, dark) = ([], d)
+        if g is not None:
+            batch.append(g)
+    return image
+
+def load_objects(source, tolerance = 0.001):
+    # The objects of an RS-274X file, in order, each a (geometry, dark)
+    # pair in mm. The image is the dark objects less the clear objects
+    # drawn after them, as load_gerber() combines them.
+    if isinstance(source, str):
+        with open(source) as f:
+            text = f.read()
+    else:
+        text = source.read()
+
+    scale = 1.0
+    decimals = 4
+    (intdigits, trailing) = (3, False)
+    macros = {}
+    apertures = {}
+    current = None
+    (x, y) = (0.0, 0.0)
+    mode = "G01"
+    multi = True
+    region = None           # contours of the open region, or None
+    dark = True
+    (mirror, rotation, lscale) = ("N", 0.0, 1.0)
+    stack = [[]]            # object lists: the image, then open blocks
+    repeats = []            # (start in stack[-1], step) of open %SR
+    cache = {}
+
+    def number(s):
+        if "." in s:
+            return float(s) * scale
+        if trailing:
+            sign = -1 if s.startswith("-") else 1
+            digits = s.lstrip("+-").ljust(intdigits + decimals, "0")
+            return sign * int(digits) / 10 ** decimals * scale
+        return int(s) / 10 ** decimals * scale
+
+    def emit(g):
+        stack[-1].append((g, dark))
+
+    def close_contour():
+        if region and len(region[-1]) > 2:
+            emit(sg.Polygon(region[-1]).buffer(0))
+        if region is not None:
+            region[-1:] = [[]]
+
+    def flash_image(d):
+        key = (d, mirror, rotation, lscale)
+        if key not in cache:
+            (kind, params) = apertures[d]
+            if kind == "BLOCK":
+                g = params
+            else:
+                g = [(_aperture(kind, params, macros, tolerance, scale), True)]
+            out = []
+            for (o, od) in g:
+                if mirror in ("X", "XY"):
+                    o = sa.scale(o, -1, 1, origin = (0, 0))
+                if mirror in ("Y", "XY"):
+                    o = sa.scale(o, 1, -1, origin = (0, 0))
+                if lscale != 1:
+                    o = sa.scale(o, lscale, lscale, origin = (0, 0))
+                if rotation:
+                    o = sa.rotate(o, rotation, origin = (0, 0))
+                out.append((o, od))
+            cache[key] = out
+        return cache[key]
+
+    def stroke(points):
+        (kind, params) = apertures[current]
+        if kind == "C" or kind == "BLOCK":
+            w = params[0] if kind == "C" else 0
+            line = sg.LineString(points) if len(points) > 1 else sg.Point(points[0])
+            emit(line.buffer(w / 2, quad_segs = 32))
+        else:
+            shape = _aperture(kind, params, macros, tolerance, scale)
+            pieces = [sa.translate(shape, *p) for p in points]
+            emit(so.unary_union([
+                so.unary_union([a, b]).convex_hull
+                for (a, b) in zip(pieces, pieces[1:])] or pieces))
+
+    tokens = re.findall(r"%[^%]*%|[^%*]*\*", text)
+    for token in tokens:
+        token = re.sub(r"\s+", "", token)
+        if not token:
+            continue
+        if token.startswith("%"):
+            body = token[1:-1]
+            if body.startswith("FS"):
+                m = re.match(r"FS([LT])[AI]X(\d)(\d)Y(\d)(\d)", body)
+                trailing = m.group(1) == "T"
+                (intdigits, decimals) = (int(m.group(2)), int(m.group(3)))
+            elif body.startswith("MO"):
+                scale = 25.4 if body.startswith("MOIN") else 1.0
+            elif body.startswith("AM"):
+                parts = body[2:].split("*")
+                macros[parts[0]] = [p for p in parts[1:] if p]
+            elif body.startswith("AD"):
+                m = re.match(r"ADD(\d+)([^,*]+),?([^*]*)\*", body)
+                (kind, params) = (m.group(2), [float(p) for p in m.group(3).split("X") if p])
+                # Sizes are in file units; macros are scaled as a whole
+                if kind in ("C", "R", "O"):
+                    params = [p * scale for p in params]
+                elif kind == "P":
+                    params[0] *= scale
+                apertures[int(m.group(1))] = (kind, params)
+            elif body.startswith("AB"):
+                m = re.match(r"ABD(\d+)", body)
+                if m:
+                    stack.append([])
+                    block = int(m.group(1))
+                    saved = (current, x, y, dark)
+                else:
+                    objects = stack.pop()
+                    apertures[block] = ("BLOCK", objects)
+                    (current, x, y, dark) = saved
+            elif body.startswith("SR"):
+                m = re.match(r"SRX(\d+)Y(\d+)I([-\d.]+)J([-\d.]+)", body)
+                if repeats:
+                    (start, (ni, nj, i, j)) = repeats.pop()
+                    objects = stack[-1][start:]
+                    del stack[-1][start:]
+                    stack[-1].extend([
+                        (sa.translate(g, a * i, b * j), d)
+                        for b in range(nj) for a in range(ni) for (g, d) in objects])
+                if m and (m.group(1), m.group(2)) != ("1", "1"):
+                    step = (int(m.group(1)), int(m.group(2)),
+                            float(m.group(3)) * scale, float(m.group(4)) * scale)
+                    repeats.append((len(stack[-1]), step))
+            elif body.startswith("LP"):
+                dark = body[2] == "D"
+            elif body.startswith("LM"):
+                mirror = body[2:-1]
+            elif body.startswith("LR"):
+                rotation = float(body[2:-1])
+            elif body.startswith("LS"):
+                lscale = float(body[2:-1])
+            continue
+
+        word = token[:-1]
+        if word.startswith("G04") or word.startswith("M02") or word.startswith("M00"):
+            continue
+        for g in re.findall(r"G(\d+)", word):
+            g = int(g)
+            if g in (1, 2, 3):
+                mode = "G0%d" % g
+            elif g == 74:
+                multi = False
+            elif g == 75:
+                multi = True
+            elif g == 36:
+                region = [[]]
+            elif g == 37:
+                close_contour()
+                region = None
+        word = re.sub(r"G\d+", "", word)
+        m = re.fullmatch(r"(?:X([-+\d.]+))?(?:Y([-+\d.]+))?(?:I([-+\d.]+))?(?:J([-+\d.]+))?(?:D(\d+))?", word)
+        if not m:
+            continue
+        (sx, sy, si, sj, sd) = m.groups()
+        d = int(sd) if sd else None
+        if d is not None and d >= 10:
+            current = d
+            continue
+        (nx, ny) = (number(sx) if sx else x, number(sy) if sy else y)
+        if d is None:
+            if sx is None and sy is None:
+                continue
+            d = 1               # deprecated modal D01
+        if d == 2:
+            if region is not None:
+                close_contour()
+                region[-1] = [(nx, ny)]
+        elif d == 3:
+            for (g, od) in flash_image(current):
+                stack[-1].append((sa.translate(g, nx, ny), od if dark else not od))
+        elif d == 1:
+            if mode == "G01":
+                points = [(nx, ny)]
+            else:
+                (i, j) = (number(si) if si else 0, number(sj) if sj else 0)
+                ccw = mode == "G03"
+                if multi:
+                    center = (x + i, y + j)
+                else:
+                    # Single quadrant: pick the signs that put the center
+                    # equally far from both ends
+                    center = min(
+                        [(x + a * i, y + b * j) for a in (1, -1) for b in (1, -1)],
+                        key = lambda c: abs(math.hypot(x - c[0], y - c[1]) -
+                                          math.hypot(nx - c[0], ny - c[1])))
+                points = _arc((x, y), (nx, ny), center, ccw, tolerance,
+                              full = multi)
+            if region is not None:
+                if not region[-1]:
+                    region[-1] = [(x, y)]
+                region[-1].extend(points)
+            else:
+                stroke([(x, y)] + points)
+        (x, y) = (nx, ny)
+    return stack[0]
+
+def load_gerber(source, tolerance = 0.001):
+    # The image of an RS-274X file, a filename or open file, as Shapely
+    # geometry in mm. Arcs and circles become polygons within tolerance.
+    # Load transformations (LM, LR, LS) apply to flashes only.
+    return _image(load_objects(source, tolerance))
+
+def load_excellon(source):
+    # The (hits, slots) of an Excellon file, both by tool diameter in mm:
+    # hits as lists of (x, y), slots as lists of ((x0, y0), (x1, y1)).
+    # R repeat codes are expanded.
+    if isinstance(source, str):
+        with open(source) as f:
+            lines = f.read().split("\n")
+    else:
+        lines = source.read().split("\n")
+
+    scale = 1.0
+    (intdigits, decimals) = (3, 3)
+    leading = False             # LZ: leading zeros kept, trailing dropped
+    tools = {}
+    hits = {}
+    slots = {}
+    tool = None
+    (x, y) = (0.0, 0.0)
+
+    def number(s):
+        if "." in s:
+            return float(s) * scale
+        sign = -1 if s.startswith("-") else 1
+        digits = s.lstrip("+-")
+        if leading:
+            digits = digits.ljust(intdigits + decimals, "0")
+        return sign * int(digits) / 10 ** decimals * scale
+
+    def coordinates(s, x, y):
+        m = re.match(r"(?:X([-+\d.]+))?(?:Y([-+\d.]+))?", s)
+        return (number(m.group(1)) if m.group(1) else x,
+                number(m.group(2)) if m.group(2) else y)
+
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith(";"):
+            continue
+        m = re.match(r"(METRIC|INCH)(?:,(LZ|TZ))?(?:,(0*)\.(0*))?", line)
+        if m:
+            scale = 1.0 if m.group(1) == "METRIC" else 25.4
+            leading = m.group(2) == "LZ"
+            if m.group(3) is not None:
+                (intdigits, decimals) = (len(m.group(3)), len(m.group(4)))
+            elif m.group(1) == "INCH":
+                (intdigits, decimals) = (2, 4)
+            continue
+        m = re.match(r"T(\d+)(?:[FS][\d.]+)*C([\d.]+)", line)
+        if m:
+            tools[int(m.group(1))] = float(m.group(2)) * scale
+            continue
+        m = re.fullmatch(r"T(\d+)", line)
+        if m:
+            tool = tools.get(int(m.group(1)))
+            continue
+        m = re.fullmatch(r"R(\d+)(.*)", line)
+        if m:
+            (dx, dy) = coordinates(m.group(2), 0, 0)
+            for _ in range(int(m.group(1))):
+                (x, y) = (x + dx, y + dy)
+                hits.setdefault(tool, []).append((x, y))
+            continue
+        if "G85" in line:
+            (a, b) = line.split("G85")
+            start = coordinates(a, x, y)
+            (x, y) = coordinates(b, *start)
+            slots.setdefault(tool, []).append((start, (x, y)))
+            continue
+        if line[0] in "XY":
+            (x, y) = coordinates(line, x, y)
+            hits.setdefault(tool, []).append((x, y))
+    return (hits, slots)
+
+def drill_geometry(hits, slots = None):
+    # The holes and slots from load_excellon() as geometry
+    shapes = [sg.Point(xy).buffer(d / 2, quad_segs = 32)
+              for (d, xys) in hits.items() for xy in xys]
+    shapes += [sg.LineString(ab).buffer(d / 2, quad_segs = 32)
+               for (d, abs_) in (slots or {}).items() for ab in abs_]
+    return so.unary_union(shapes)
+
+def load(filename, tolerance = 0.001):
+    # The geometry of a Gerber file, or of an Excellon ".TXT" file
+    if filename.upper().endswith(".TXT"):
+        return drill_geometry(*load_excellon(filename))
+    return load_gerber(filename, tolerance)
+
+def compare(old, new, tolerance = 0.005):
+    # Where two images differ by more than tolerance. Slivers narrower
+    # than 2 * tolerance, as left by arcs and rounding, are ignored.
+    changed = old.symmetric_difference(new).buffer(-tolerance)
+    return changed.buffer(tolerance) if not changed.is_empty else changed
+
+# Extensions of the files a build writes, Gerber layers then drill
+EXTENSIONS = ("GTL", "GL2", "G2L", "GL3", "G3L", "GBL", "GTS", "GBS",
+              "GTO", "GBO", "GTP", "GBP", "GML", "TXT")
+
+def main(old, new, extensions = None):
+    # Compare the outputs of two builds, given as basenames
+    extensions = extensions or EXTENSIONS
+    status = 0
+    for ext in extensions:
+        (a, b) = (old + "." + ext, new + "." + ext)
+        if not (os.path.exists(a) and os.path.exists(b)):
+            continue
+        diff = compare(load(a), load(b))
+        if diff.is_empty:
+            print("%-4s same" % ext)
+        else:
+            status = 1
+            print("%-4s changed %.4f mm2 in (%.3f, %.3f, %.3f, %.3f)" %
+                  ((ext, diff.area) + diff.bounds))
+    return status
+
+if __name__ == "__main__":
+    sys.exit(main(*sys.argv[1:3], extensions = sys.argv[3:] or None))
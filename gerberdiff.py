@@ -0,0 +1,187 @@
+"""Show what changed between two builds of a board, by raster XOR.
+
+Each layer of the old and new build is loaded with gerber_loader,
+rasterized with raster at ``ppmm`` pixels per mm, and the two masks
+XORed. For each changed layer this reports the changed area and the
+bounding box of each changed region, and writes a PNG with removed
+copper in red and added copper in green over the unchanged image.
+
+    python gerberdiff.py old/spiq_a spiq_a
+    python gerberdiff.py --ppmm 10 --png diffs old/ .
+
+Given two directories, every build in the first (found by its .GML
+file) is compared with the build of the same name in the second.
+Files that are byte-for-byte identical are not loaded at all. The exit
+status is 1 if anything changed.
+"""
+
+import argparse
+import filecmp
+import glob
+import os
+import sys
+
+import numpy as np
+import shapely
+from PIL import Image
+
+import gerber_loader
+import raster
+
+def _objects(filename, ppmm):
+    # (geometry, dark) objects of a layer, arcs good to a quarter pixel
+    if filename.upper().endswith(".TXT"):
+        (hits, slots) = gerber_loader.load_excellon(filename)
+        return [(gerber_loader.drill_geometry({d: [xy]}), True)
+                for (d, xys) in hits.items() for xy in xys] + [
+                (gerber_loader.drill_geometry({}, {d: [ab]}), True)
+                for (d, abs_) in slots.items() for ab in abs_]
+    objects = gerber_loader.load_objects(filename, 0.25 / ppmm)
+    if filename.upper().endswith(".GML"):
+        # Outlines are hairlines; make them at least a pixel wide
+        objects = [(g.buffer(0.5 / ppmm), d) for (g, d) in objects]
+    return objects
+
+def _bounds(*object_lists):
+    geoms = [g for objects in object_lists for (g, _) in objects]
+    if not geoms:
+        return None
+    (x0, y0, x1, y1) = shapely.total_bounds(geoms)
+    return (float(x0), float(y0), float(x1), float(y1))
+
+def erode(mask, n = 1):
+    # mask less the pixels within n pixels of its edge
+    for _ in range(n):
+        m = mask.copy()
+        m[1:] &= mask[:-1]
+        m[:-1] &= mask[1:]
+        m[:, 1:] &= mask[:, :-1]
+        m[:, :-1] &= mask[:, 1:]
+        mask = m
+    return mask
+
+def grow(seed, mask):
+    # The pixels of mask joined to a pixel of seed through mask
+    grown = seed & mask
+    n = grown.sum()
+    while True:
+        g = grown.copy()
+        g[1:] |= grown[:-1]
+        g[:-1] |= grown[1:]
+        g[:, 1:] |= grown[:, :-1]
+        g[:, :-1] |= grown[:, 1:]
+        g &= mask
+        (grown, m) = (g, g.sum())
+        if m == n:
+            return grown
+        n = m
+
+def regions(mask, bounds, ppmm, cell = 1.0):
+    # Bounding boxes in mm of the set regions of mask, where set pixels
+    # within cell mm of each other are one region
+    (h, w) = mask.shape
+    c = max(1, int(round(cell * ppmm)))
+    (ch, cw) = (-(-h // c), -(-w // c))
+    padded = np.zeros((ch * c, cw * c), bool)
+    padded[:h, :w] = mask
+    coarse = padded.reshape(ch, c, cw, c).any(axis = (1, 3))
+    seen = np.zeros_like(coarse)
+    (x0, _, _, y1) = bounds
+    boxes = []
+    for (i, j) in zip(*np.nonzero(coarse)):
+        if seen[i, j]:
+            continue
+        seen[i, j] = True
+        (stack, cells) = ([(i, j)], [])
+        while stack:
+            (a, b) = stack.pop()
+            cells.append((a, b))
+            for p in range(max(0, a - 1), min(ch, a + 2)):
+                for q in range(max(0, b - 1), min(cw, b + 2)):
+                    if coarse[p, q] and not seen[p, q]:
+                        seen[p, q] = True
+                        stack.append((p, q))
+        (rows, cols) = zip(*cells)
+        (r, k) = (min(rows) * c, min(cols) * c)
+        sub = padded[r:(max(rows) + 1) * c, k:(max(cols) + 1) * c]
+        rr = np.flatnonzero(sub.any(axis = 1))
+        cc = np.flatnonzero(sub.any(axis = 0))
+        boxes.append((x0 + (k + cc[0]) / ppmm, y1 - (r + rr[-1] + 1) / ppmm,
+                      x0 + (k + cc[-1] + 1) / ppmm, y1 - (r + rr[0]) / ppmm))
+    return boxes
+
+def write_png(filename, old, new):
+    # Write old and new masks as a PNG, removed red and added green
+    rgb = np.zeros(old.shape + (3,), np.uint8)
+    rgb[old & new] = (96, 96, 96)
+    rgb[old & ~new] = (255, 48, 48)
+    rgb[new & ~old] = (48, 255, 48)
+    Image.fromarray(rgb).save(filename)
+
+def diff_layer(old, new, ppmm = 20, slack = 1):
+    # Compare two files of a layer. Returns (area, boxes, (old_mask,
+    # new_mask)), area the changed area in mm2 or None if the files are
+    # identical. Changes no more than slack pixels wide, such as edges
+    # moved by rounding or arcs, are ignored; the others are measured
+    # whole.
+    if filecmp.cmp(old, new, shallow = False):
+        return None
+    (a, b) = (_objects(old, ppmm), _objects(new, ppmm))
+    bounds = _bounds(a, b)
+    if bounds is None:
+        return None
+    # A pixel of margin, so nothing is clipped at the edges
+    m = 1 / ppmm
+    bounds = (bounds[0] - m, bounds[1] - m, bounds[2] + m, bounds[3] + m)
+    (ma, mb) = (raster.paint(a, bounds, ppmm), raster.paint(b, bounds, ppmm))
+    xor = ma ^ mb
+    changed = grow(erode(xor, slack), xor)
+    area = changed.sum() / ppmm ** 2
+    return (area, regions(changed, bounds, ppmm) if area else [], (ma, mb))
+
+def diff(old, new, ppmm = 20, png = None, slack = 1):
+    # Compare every layer of two builds, given as basenames, printing a
+    # line per changed layer and per changed region. With png set, write
+    # a PNG of each changed layer to that directory. Returns True if
+    # anything changed.
+    name = os.path.basename(new)
+    changes = False
+    for ext in gerber_loader.EXTENSIONS:
+        (a, b) = (old + "." + ext, new + "." + ext)
+        if not (os.path.exists(a) and os.path.exists(b)):
+            continue
+        result = diff_layer(a, b, ppmm, slack)
+        if result is None or result[0] == 0:
+            continue
+        changes = True
+        (area, boxes, (ma, mb)) = result
+        print("%s.%s: %.4f mm2 changed in %d regions" % (name, ext, area, len(boxes)))
+        for box in boxes:
+            print("    (%.2f, %.2f) - (%.2f, %.2f)" % box)
+        if png:
+            write_png(os.path.join(png, "%s-%s.png" % (name, ext)), ma, mb)
+    return changes
+
+def main(argv = None):
+    p = argparse.ArgumentParser(description = "Raster XOR of two board builds")
+    p.add_argument("old", help = "old basename, or directory of builds")
+    p.add_argument("new", help = "new basename, or directory of builds")
+    p.add_argument("--ppmm", type = float, default = 20, help = "pixels per mm")
+    p.add_argument("--slack", type = int, default = 1,
+                   help = "ignore changes up to this many pixels wide")
+    p.add_argument("--png", help = "directory for the PNGs of changed layers")
+    args = p.parse_args(argv)
+    if args.png:
+        os.makedirs(args.png, exist_ok = True)
+    if os.path.isdir(args.old):
+        names = sorted(os.path.basename(f)[:-4]
+                       for f in glob.glob(os.path.join(args.old, "*.GML")))
+        pairs = [(os.path.join(args.old, n), os.path.join(args.new, n))
+                 for n in names]
+    else:
+        pairs = [(args.old, args.new)]
+    changes = [diff(a, b, args.ppmm, args.png, args.slack) for (a, b) in pairs]
+    return int(any(changes))
+
+if __name__ == "__main__":
+    sys.exit(main())
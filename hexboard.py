@@ -1,13 +1,16 @@
+import math
+import os
+import time
+
 import numpy as np
 import shapely
 import shapely.geometry as sg
-import shapely.ops as so
-from collections import deque
 from shapely.strtree import STRtree
-from PIL import Image, ImageDraw, ImageFont
 
 import cuflow as cu
-from hex import Hex, axial_direction_vectors
+import hexroute
+import raster
+from hex import Hex
 
 twenty_rgb = [
 (230, 25, 75), (60, 180, 75), (255, 225, 25), (0, 130, 200), (245, 130, 48), (145, 30, 180), (70, 240, 240), (240, 50, 230), (210, 245, 60), (250, 190, 212), (0, 128, 128), (220, 190, 255), (170, 110, 40), (255, 250, 200), (128, 0, 0), (170, 255, 195), (128, 128, 0), (255, 215, 180), (0, 0, 128), (128, 128, 128), (255, 255, 255), (0, 0, 0)
@@ -84,14 +87,22 @@ class HexBoard(cu.Board):
 
         self.gr = ByteGrid(*self.size)
         self.route_hexes = tuple(self.gr.valids())
-        self.valid_cells = frozenset(
-            (h.q, h.r) for h in self.route_hexes)
         coordinates = np.asarray([h.to_plane() for h in self.route_hexes])
         route_disks = shapely.buffer(
             shapely.points(coordinates), self.hr, quad_segs=16)
         self.route_tree = STRtree(route_disks)
-        self.blocked = {layer: self.layer_blocks(layer) for layer in ('GTL', 'GBL')}
+        # Routes keep clear of cells within via_clear of a via, and other
+        # vias clear of cells within via_apart
+        clear = self.via / 2 + max(self.space, self.via_space) + self.trace / 2
+        apart = self.via + self.via_space
+        border = math.ceil(max(clear, apart) / (hd * math.sqrt(3) / 2))
+        self.grid = hexroute.Grid(self.gr, border)
+        self.via_clear = self.grid.disc(clear)
+        self.via_apart = self.grid.disc(apart)
+        self.hex_layers = ('GTL', 'GBL')
+        self.blocked = {layer: self.grid.flat(self.layer_blocks(layer)) for layer in self.hex_layers}
         self.routes = []
+        self.hex_vias = []
 
     def layer_blocks(self, nm):
         copper = [p for (_, p) in self.layers[nm].polys]
@@ -102,169 +113,181 @@ class HexBoard(cu.Board):
             for diameter, locations in self.holes.items()
             for xy in locations
         ]
-        layer_poly = so.unary_union(
+        obstacles = (
             copper + drill_keepouts + self.keepouts +
-            self.route_keepouts[nm]).buffer(0)
+            self.route_keepouts[nm])
         blocked = self.gr.zeros(np.uint8) | (self.gr.valid == 0)
-        for i in self.route_tree.query(layer_poly, predicate="intersects"):
+        obstacles = np.array(obstacles, dtype = object)
+        (_, hits) = self.route_tree.query(obstacles, predicate="intersects")
+        for i in np.unique(hits):
             h = self.route_hexes[i]
             blocked[h.q, h.r] = 1
         return blocked
 
-    def hex_route(self, a, b):
-        layer = a.layer
-        assert b.layer == a.layer
+    def hex_route(self, a, b, via_cost = None):
+        # Route a to b. Given via_cost, a whole number of steps, the route
+        # may change layer through vias; it must if a and b are on
+        # different layers, and via_cost is then 10 unless given.
         source = a
         target = b
-        a = Hex.from_xy(*source.xy)
-        b = Hex.from_xy(*target.xy)
-
-        wavefront = set([tuple(a)])
-        dirs = [Hex(dq,dr) for (dq, dr) in axial_direction_vectors]
-
-        valid = self.valid_cells
-        blocked = self.blocked[layer].copy()
-        blocked[b.q, b.r] = 0
-        distance = self.gr.zeros(np.uint8)
-
-        i = 1
-        while tuple(b) not in wavefront:
-            wavefront2 = set()
-            for p in wavefront:
-                h = Hex(*p)
-                for d in dirs:
-                    n = h + d
-                    if tuple(n) in valid and not blocked[n.q, n.r]:
-                        wavefront2.add(tuple(n))
-                        blocked[n.q, n.r] = 1
-                        distance[n.q, n.r] = i
-            assert wavefront2 != wavefront, f"Signal failed to route"
-            wavefront = wavefront2
-            # print(f"{i=} {wavefront=}")
-
-            i += 1
-        
-        route = [b]
-        p = b
-        while distance[p.q, p.r] != 1:
-            n = distance[p.q, p.r]
-            assert n != 0
-            for d in dirs:
-                if distance[p.q + d.q, p.r + d.r] == (n - 1):
-                    p = p + d
-                    route.append(p)
-                    self.blocked[layer][p.q, p.r] = 1
-                    break
-        route.append(a)
-        self.routes.append((layer, route))
+        g = self.grid
+        a = g.index(Hex.from_xy(*source.xy))
+        b = g.index(Hex.from_xy(*target.xy))
+
+        if via_cost is None and source.layer == target.layer:
+            layer = source.layer
+            route = g.astar(self.blocked[layer], a, b)
+            assert route is not None, f"Signal failed to route"
+            for i in route[1:-1]:
+                self.blocked[layer][i] = hexroute.COPPER
+            self.routes.append((layer, [g.hex(i) for i in route]))
+        else:
+            self.hex_route_layers(a, source.layer, b, target.layer,
+                                  10 if via_cost is None else via_cost)
         self.addnet(source, target)
 
+    def hex_route_layers(self, a, la, b, lb, via_cost):
+        # Route cell a on layer la to cell b on layer lb, on any layer
+        g = self.grid
+        n = g.size
+        layers = self.hex_layers
+        blocked = [self.blocked[layer] for layer in layers]
+        vias = g.sites(blocked, self.via_clear, self.via_apart)
+        a += layers.index(la) * n
+        b += layers.index(lb) * n
+        route = g.layered(bytearray().join(blocked), vias, a, b, via_cost)
+        assert route is not None, f"Signal failed to route"
+        self.hex_add_layered(route)
+
+    def hex_add_layered(self, route):
+        # Add route, cells numbered on hex_layers one after another as for
+        # Grid.layered(), as a wire for each layer split at the vias
+        g = self.grid
+        n = g.size
+        layers = self.hex_layers
+        for i in route[1:-1]:
+            self.blocked[layers[i // n]][i % n] = hexroute.COPPER
+        wire = [route[0]]
+        for (p, i) in zip(route, route[1:]):
+            if i % n == p % n:
+                self.routes.append((layers[p // n], [g.hex(j % n) for j in wire]))
+                self.hex_via(i % n)
+                wire = []
+            wire.append(i)
+        self.routes.append((layers[wire[0] // n], [g.hex(j % n) for j in wire]))
+
+    def hex_via(self, i):
+        # A via at cell i, on every layer
+        hexroute.add_via(self.blocked.values(), i, self.via_clear)
+        self.hex_vias.append(self.grid.hex(i))
+
     def hex_route_net(self, terminals):
         terminals = tuple(terminals)
-        assert len(terminals) == 3, "hex_route_net() currently supports 3-node nets"
+        assert len(terminals) >= 2, "hex_route_net() needs at least 2 terminals"
 
         layer = terminals[0].layer
         assert all(terminal.layer == layer for terminal in terminals)
 
-        terminal_hexes = [Hex.from_xy(*terminal.xy) for terminal in terminals]
-        terminal_cells = {tuple(h) for h in terminal_hexes}
-        valid = self.valid_cells
-        blocked = self.blocked[layer]
-        directions = [Hex(dq, dr) for dq, dr in axial_direction_vectors]
-
-        def wavefront(start):
-            start = tuple(start)
-            distance = {start: 0}
-            previous = {}
-            pending = deque([start])
-            while pending:
-                cell = pending.popleft()
-                h = Hex(*cell)
-                for direction in directions:
-                    neighbor = h + direction
-                    neighbor_cell = tuple(neighbor)
-                    if neighbor_cell not in valid or neighbor_cell in distance:
-                        continue
-                    if (neighbor_cell not in terminal_cells and
-                            blocked[neighbor.q, neighbor.r]):
-                        continue
-                    distance[neighbor_cell] = distance[cell] + 1
-                    previous[neighbor_cell] = cell
-                    pending.append(neighbor_cell)
-            return distance, previous
-
-        searches = [wavefront(h) for h in terminal_hexes]
-        common = set(searches[0][0])
-        for distance, _ in searches[1:]:
-            common.intersection_update(distance)
-        assert common, "Signal net failed to route"
-
-        junction = min(common, key=lambda cell: (
-            sum(distance[cell] for distance, _ in searches),
-            max(distance[cell] for distance, _ in searches),
-            cell[1],
-            cell[0],
-        ))
-
-        routes = []
-        occupied = set()
-        for terminal, (_, previous) in zip(terminal_hexes, searches):
-            terminal_cell = tuple(terminal)
-            cell = junction
-            route = [Hex(*cell)]
-            occupied.add(cell)
-            while cell != terminal_cell:
-                cell = previous[cell]
-                route.append(Hex(*cell))
-                occupied.add(cell)
-            routes.append(route)
-
-        for q, r in occupied:
-            self.blocked[layer][q, r] = 1
+        g = self.grid
+        cells = [g.index(Hex.from_xy(*terminal.xy)) for terminal in terminals]
+        branches = g.steiner(self.blocked[layer], cells)
+        assert branches is not None, "Signal net failed to route"
+
+        routes = [[g.hex(i) for i in branch] for branch in branches]
+        for branch in branches:
+            for i in branch:
+                self.blocked[layer][i] = hexroute.COPPER
         self.routes.extend((layer, route) for route in routes)
         for terminal in terminals[1:]:
             self.addnet(terminals[0], terminal)
 
         return routes
 
+    def hex_nets(self, connections):
+        # connections, each a pair or tuple of terminals, as hexroute nets
+        g = self.grid
+        nets = []
+        for terminals in connections:
+            layer = terminals[0].layer
+            assert all(terminal.layer == layer for terminal in terminals)
+            nets.append((layer, [g.index(Hex.from_xy(*t.xy)) for t in terminals]))
+        return nets
+
+    def hex_add_routes(self, connections, nets, routes):
+        g = self.grid
+        for (terminals, (layer, _), branches) in zip(connections, nets, routes):
+            for branch in branches:
+                for i in branch:
+                    self.blocked[layer][i] = hexroute.COPPER
+                self.routes.append((layer, [g.hex(i) for i in branch]))
+            for terminal in terminals[1:]:
+                self.addnet(terminals[0], terminal)
+
+    def hex_route_all(self, connections, iterations = 50):
+        # Route connections, each a pair or tuple of terminals, together
+        # by negotiated congestion, so that the result does not depend on
+        # their order. Returns the statistics of each iteration.
+        connections = [tuple(c) for c in connections]
+        nets = self.hex_nets(connections)
+        (routes, stats) = hexroute.negotiate(self.grid, self.blocked, nets, iterations)
+        self.hex_add_routes(connections, nets, routes)
+        return stats
+
+    def hex_route_orders(self, connections, k = 16, workers = None, seed = 0,
+                         via_cost = None):
+        # Route connections one at a time, as hex_route() would with
+        # via_cost, in each of k orders, on workers processes. Keep the
+        # routing that routes the most connections, then has the fewest
+        # vias, then is shortest. workers may be a list of counts, to run
+        # the search with each and compare the completion rates. Returns
+        # (order, (connections failed, vias, steps)) for each order.
+        connections = [tuple(c) for c in connections]
+        nets = self.hex_nets(connections)
+        counts = workers if isinstance(workers, (list, tuple)) else [workers]
+        for w in counts:
+            t0 = time.perf_counter()
+            (routes, best, tried) = hexroute.search(
+                self.grid, self.blocked, nets, k, w, seed,
+                via_cost, self.via_clear, self.via_apart)
+            t = time.perf_counter() - t0
+            complete = sum(failed == 0 for (_, (failed, _, _)) in tried)
+            print(f"Route orders, {w or os.cpu_count()} workers: "
+                  f"{complete}/{len(tried)} complete ({100 * complete / len(tried):.0f}%), "
+                  f"{t:.2f} s, {complete / t:.1f} complete/s")
+        assert best[0] == 0, f"Signal failed to route: {best[0]} connections in the best of {len(tried)} orders"
+        for (terminals, branches) in zip(connections, routes):
+            for branch in branches:
+                self.hex_add_layered(branch)
+            for terminal in terminals[1:]:
+                self.addnet(terminals[0], terminal)
+        return tried
+
     def hex_render(self):
         (w, h) = self.size
         (hd, _) = (Hex(1, 0).to_plane())    # hd is the center-center distance
-        hr = hd / 2                         # hr is the hex radius
-
         ppmm = 25   # pixels per mm
-        im = Image.new("RGB", (int(w * ppmm), int(h * ppmm)), 'black')
-        dr = ImageDraw.Draw(im)
-        def xf(xy):
-            (x, y) = xy
-            return (x * ppmm, (self.size[1]  - y) * ppmm)
-
-        def draw_geometry(geometry):
-            if isinstance(geometry, sg.Polygon):
-                dr.polygon(
-                    [xf(point) for point in geometry.exterior.coords],
-                    fill = (60, 60, 160))
-                for interior in geometry.interiors:
-                    dr.polygon(
-                        [xf(point) for point in interior.coords],
-                        fill = 'black')
-            elif hasattr(geometry, "geoms"):
-                for child in geometry.geoms:
-                    draw_geometry(child)
-
-        for _, polygon in self.layers['GTL'].polys:
-            draw_geometry(polygon)
-
-        for h in self.gr.valids():
-            if not self.blocked['GTL'][h.q, h.r]:
-                dr.circle(xf(h.to_plane()), outline = (110, 110, 110), radius = hd * ppmm / 2)
+
+        def discs(hexes, r, hole = 0):
+            # Discs of radius r on hexes, as rings if hole is set
+            p = shapely.points([h.to_plane() for h in hexes])
+            d = shapely.buffer(p, r)
+            if hole:
+                inner = shapely.get_exterior_ring(shapely.buffer(p, hole))
+                d = shapely.polygons(shapely.get_exterior_ring(d), holes = inner[:, None])
+            return d
+
+        layers = [([p for _, p in self.layers['GTL'].polys], (60, 60, 160))]
+
+        # Free cells as a pixel-wide ring
+        free = [self.grid.hex(i) for i in self.grid.cells(self.blocked['GTL'])]
+        if free:
+            layers.append((discs(free, hd / 2, hd / 2 - 1 / ppmm), (110, 110, 110)))
 
         if 1:
             for color,(layer, r) in zip(twenty_rgb, self.routes):
-                for e in r:
-                    dr.circle(xf(e.to_plane()), fill = color, radius = hd * ppmm / 2)
+                layers.append((discs(r, hd / 2), color))
 
-        im.save("out.png")
+        raster.save("out.png", layers, (0, 0, w, h), ppmm)
 
     def wire_routes(self):
         for (layer, r) in self.routes:
@@ -272,6 +295,8 @@ class HexBoard(cu.Board):
             for p in r[1:]:
                 d.path.append(p.to_plane())
             d.wire()
+        for h in self.hex_vias:
+            self.DC(h.to_plane()).via()
 
 
 def best_forward(p):
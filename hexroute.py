@@ -0,0 +1,469 @@
+"""Shortest paths on the hex routing grid.
+
+The cells of a ByteGrid are numbered row by row in a flat array, one
+row per q, with a border of blocked cells all round. Each of the six
+neighbours of a cell is then a fixed offset away, and never off the
+edge of the array. Occupancy is a bytearray over these cells, nonzero
+where a route may not go: COPPER where there is copper or a route, VIA
+where there is a via, and CLEAR round a via, where a route would be too
+close to it but another via may still reach.
+
+Routes across layers search the occupancy of each layer one after
+another, so that cell i of layer k is numbered k * size + i.
+"""
+
+import heapq
+import math
+import os
+import random
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from hex import Hex, axial_direction_vectors
+
+(COPPER, CLEAR, VIA) = (1, 2, 3)
+
+class Grid:
+    def __init__(self, gr, border = 1):
+        # border is the width of the blocked border, at least the reach of
+        # any offsets from disc()
+        (nq, nr) = gr.valid.shape
+        self.q0 = gr.q0
+        self.border = border
+        self.stride = nr + 2 * border
+        self.shape = (nq + 2 * border, nr + 2 * border)
+        self.size = self.shape[0] * self.shape[1]
+        # ByteGrid arrays are indexed by q, so negative q wraps round
+        self.rows = np.arange(gr.q0, gr.q1) % nq
+        self.offsets = tuple(dq * self.stride + dr for (dq, dr) in axial_direction_vectors)
+        self.valid = np.zeros(self.shape, bool)
+        self.valid[border:-border, border:-border] = gr.valid[self.rows] != 0
+        self.valid = self.valid.ravel()
+
+    def flat(self, a):
+        # ByteGrid array a as occupancy: nonzero cells and the border blocked
+        b = self.border
+        f = np.full(self.shape, COPPER, np.uint8)
+        f[b:-b, b:-b] = a[self.rows] != 0
+        return bytearray(f.tobytes())
+
+    def index(self, h):
+        return (h.q - self.q0 + self.border) * self.stride + h.r + self.border
+
+    def hex(self, i):
+        (c, r) = divmod(i, self.stride)
+        return Hex(c - self.border + self.q0, r - self.border)
+
+    def disc(self, radius):
+        # Offsets of the cells whose centres are less than radius from the
+        # centre of a cell, other than the cell itself
+        (hd, _) = Hex(1, 0).to_plane()
+        n = int(radius / hd * 2) + 1
+        near = [(dq, dr) for dq in range(-n, n + 1) for dr in range(-n, n + 1)
+                if 0 < math.hypot(*Hex(dq, dr).to_plane()) < radius]
+        assert all(max(abs(dq), abs(dr)) <= self.border for (dq, dr) in near)
+        return tuple(dq * self.stride + dr for (dq, dr) in near)
+
+    def distance(self, a, b):
+        # Distance from cell a to cell b, ignoring what is blocked
+        (dq, dr) = (a // self.stride - b // self.stride, a % self.stride - b % self.stride)
+        return (abs(dq) + abs(dr) + abs(dq + dr)) >> 1
+
+    def cells(self, occupancy, value = 0):
+        # Indices of the valid cells whose occupancy is value
+        o = np.frombuffer(occupancy, np.uint8)
+        return np.flatnonzero(self.valid & (o == value)).tolist()
+
+    def astar(self, blocked, a, b):
+        # Shortest path from cell a to cell b through unblocked cells,
+        # as a list of cells from b back to a; None if there is none.
+        # a and b themselves may be blocked.
+        cost = self.search(blocked, a, b)
+        if cost[b] == -1:
+            return None
+        return self.walk(cost, b)
+
+    def search(self, blocked, a, b):
+        # A* from a towards b. Returns the cost array: the exact distance
+        # from a for every cell on a shortest path to b, -1 for cells not
+        # reached. The search goes on until no cell left could be on a
+        # shortest path, so walk() sees them all.
+        s = self.stride
+        (bq, br) = divmod(b, s)
+        offsets = self.offsets
+        cost = array("l", [-1]) * self.size
+        cost[a] = 0
+        (q, r) = divmod(a, s)
+        (dq, dr) = (q - bq, r - br)
+        h = (abs(dq) + abs(dr) + abs(dq + dr)) >> 1
+        heap = [(h, h, a)]
+        pop = heapq.heappop
+        push = heapq.heappush
+        best = None
+        while heap:
+            (f, h, i) = pop(heap)
+            if best is not None and f > best:
+                break
+            g = f - h
+            if g != cost[i]:
+                continue            # already reached more cheaply
+            if i == b:
+                best = g
+                continue
+            g += 1
+            for o in offsets:
+                j = i + o
+                if blocked[j] and j != b:
+                    continue
+                c = cost[j]
+                if c != -1 and c <= g:
+                    continue
+                cost[j] = g
+                (q, r) = divmod(j, s)
+                (dq, dr) = (q - bq, r - br)
+                h = (abs(dq) + abs(dr) + abs(dq + dr)) >> 1
+                push(heap, (g + h, h, j))
+        return cost
+
+    def walk(self, dist, b, cost = None):
+        # Walk back from b down the distance array to a cell at 0, taking
+        # the first direction that is a step along a shortest path, as the
+        # old wavefront router did, so routes come out the same. Entering
+        # cell j costs cost[j], or 1 if cost is None.
+        route = [b]
+        p = b
+        while dist[p] != 0:
+            step = 1 if cost is None else cost[p]
+            for o in self.offsets:
+                if dist[p + o] + step == dist[p]:
+                    p += o
+                    break
+            route.append(p)
+        return route
+
+    def sites(self, blocked, clear, apart):
+        # Occupancy for vias, given the occupancy of each layer: a via may
+        # go where no layer has anything in the cell itself, copper or a
+        # via at offsets clear, or a via at offsets apart.
+        o = np.stack([np.frombuffer(b, np.uint8) for b in blocked])
+        copper = ((o == COPPER) | (o == VIA)).any(0)
+        via = (o == VIA).any(0)
+        f = o.any(0)
+        for d in clear:
+            f |= np.roll(copper, -d)
+        for d in apart:
+            f |= np.roll(via, -d)
+        return bytearray(f.astype(np.uint8).tobytes())
+
+    def layered(self, blocked, vias, a, b, via_cost):
+        # Shortest path from cell a to cell b, on any layer. blocked is the
+        # occupancy of every layer one after another, and vias that of
+        # sites(). A route moves within a layer as astar() does, or to the
+        # same cell on another layer through a via, at a cost of via_cost
+        # steps. Returns a list of cells from b back to a; None if there
+        # is none. a and b themselves may be blocked.
+        n = self.size
+        s = self.stride
+        layers = range(0, len(blocked), n)
+        (bq, br) = divmod(b % n, s)
+        offsets = self.offsets
+        cost = array("l", [-1]) * len(blocked)
+        cost[a] = 0
+        (q, r) = divmod(a % n, s)
+        (dq, dr) = (q - bq, r - br)
+        h = (abs(dq) + abs(dr) + abs(dq + dr)) >> 1
+        heap = [(h, h, a)]
+        pop = heapq.heappop
+        push = heapq.heappush
+        best = None
+        while heap:
+            (f, h, i) = pop(heap)
+            if best is not None and f > best:
+                break
+            g = f - h
+            if g != cost[i]:
+                continue            # already reached more cheaply
+            if i == b:
+                best = g
+                continue
+            c = i % n
+            moves = [(i + o, g + 1) for o in offsets]
+            if not vias[c]:
+                moves += [(k + c, g + via_cost) for k in layers if k + c != i]
+            for (j, gj) in moves:
+                if blocked[j] and j != b:
+                    continue
+                cj = cost[j]
+                if cj != -1 and cj <= gj:
+                    continue
+                cost[j] = gj
+                if j % n != c:
+                    (q, r) = divmod(j % n, s)
+                    (dq, dr) = (q - bq, r - br)
+                    h = (abs(dq) + abs(dr) + abs(dq + dr)) >> 1
+                push(heap, (gj + h, h, j))
+        if cost[b] == -1:
+            return None
+        # Walk back as walk() does, through a via only where one may go
+        route = [b]
+        p = b
+        while cost[p] != 0:
+            c = p % n
+            steps = [p + o for o in offsets if cost[p + o] + 1 == cost[p]]
+            if not vias[c]:
+                steps += [k + c for k in layers
+                          if k + c != p and cost[k + c] != -1 and cost[k + c] + via_cost == cost[p]]
+            p = steps[0]
+            route.append(p)
+        return route
+
+    def steiner(self, blocked, terminals, cost = None):
+        # Connect cells terminals with a tree through unblocked cells. The
+        # tree starts as the first terminal, and each step joins it to the
+        # nearest terminal not yet in it. Entering cell j costs cost[j], or
+        # 1 if cost is None. Returns the branches, each a list of cells
+        # from a terminal back to a cell already in the tree; None if some
+        # terminal cannot be reached. Terminals may be blocked.
+        offsets = self.offsets
+        ends = set(terminals)
+        # dist is the distance from the tree, and heap the Dijkstra
+        # frontier. Both carry over from step to step: the cells of a new
+        # branch go in at 0, and each step searches only as far as the
+        # nearest terminal, so the search is never repeated from scratch.
+        dist = array("d", [math.inf]) * self.size
+        heap = []
+        pop = heapq.heappop
+        push = heapq.heappush
+        (new, left) = ([terminals[0]], set(terminals))
+        branches = []
+        while True:
+            for i in new:
+                dist[i] = 0
+                push(heap, (0, i))
+            left -= set(new)
+            if not left:
+                return branches
+            nearest = min(dist[t] for t in left)
+            while heap and heap[0][0] < nearest:
+                (d, i) = pop(heap)
+                if d != dist[i]:
+                    continue        # already reached more cheaply
+                for o in offsets:
+                    j = i + o
+                    if blocked[j] and j not in ends:
+                        continue
+                    g = d + (1 if cost is None else cost[j])
+                    if dist[j] <= g:
+                        continue
+                    dist[j] = g
+                    push(heap, (g, j))
+                    if j in left and g < nearest:
+                        nearest = g
+            if nearest == math.inf:
+                return None
+            t = min((t for t in left if dist[t] == nearest), key = terminals.index)
+            new = self.walk(dist, t, cost)
+            branches.append(new)
+
+def negotiate(grid, blocked, nets, iterations = 50, present = 0.5, growth = 1.5,
+              history = 1.0, verbose = True):
+    # Route nets together by negotiated congestion (PathFinder). nets is a
+    # list of (layer, terminal cells), and blocked the occupancy of each
+    # layer; neither is changed. At first nets may share cells, at a cost
+    # that grows with every iteration and with the history of congestion
+    # in the cell, until no cell is shared. After the first iteration only
+    # the nets through shared cells are ripped up and rerouted.
+    # Two nets that must cross can slide their crossing along from cell to
+    # cell, each new cell with no history. So each net also remembers how
+    # often it has clashed with each other net, and cells of that net cost
+    # it more, however fresh.
+    # Once no cell is shared, each net in turn is rerouted around all the
+    # others, keeping the new route if it is shorter, until none gets
+    # shorter.
+    # Returns the branches of each net, as for Grid.steiner(), and for
+    # each iteration (nets routed, cells overused, seconds).
+
+    # Nets that share a terminal are one net, routed as the first of them
+    root = list(range(len(nets)))
+    def find(n):
+        while root[n] != n:
+            n = root[n]
+        return n
+    first = {}
+    for (n, (layer, cells)) in enumerate(nets):
+        for c in cells:
+            (a, b) = (find(n), find(first.setdefault((layer, c), n)))
+            root[max(a, b)] = min(a, b)
+    terminals = {}
+    for (n, (layer, cells)) in enumerate(nets):
+        t = terminals.setdefault(find(n), [])
+        t.extend(c for c in cells if c not in t)
+    groups = sorted(terminals)
+
+    occupied = {layer: np.zeros(grid.size, np.int32) for layer in blocked}
+    hist = {layer: np.zeros(grid.size) for layer in blocked}
+    routes = {}
+    used = {}
+    clashes = {n: {} for n in groups}
+    pending = groups
+    stats = []
+    for iteration in range(iterations):
+        t0 = time.perf_counter()
+        for n in pending:
+            layer = nets[n][0]
+            occ = occupied[layer]
+            if n in used:
+                occ[used[n]] -= 1
+            rivals = occ.copy()
+            for (m, k) in clashes[n].items():
+                rivals[used[m]] += k
+            cost = ((1 + hist[layer]) * (1 + present * rivals)).tolist()
+            branches = grid.steiner(blocked[layer], terminals[n], cost)
+            assert branches is not None, "Signal failed to route"
+            routes[n] = branches
+            used[n] = np.unique(np.concatenate(branches))
+            occ[used[n]] += 1
+        overused = sum(int((occ > 1).sum()) for occ in occupied.values())
+        stats.append((len(pending), overused, time.perf_counter() - t0))
+        if verbose:
+            print(f"Negotiate {iteration:2d}: {len(pending):3d} nets routed, "
+                  f"{overused:4d} cells overused, {stats[-1][2]:.3f} s")
+        if overused == 0:
+            break
+        for layer in occupied:
+            hist[layer] += history * np.maximum(occupied[layer] - 1, 0)
+        present = min(present * growth, 1e6)
+        pending = [n for n in groups if (occupied[nets[n][0]][used[n]] > 1).any()]
+        for (i, n) in enumerate(pending):
+            for m in pending[:i]:
+                if nets[n][0] == nets[m][0] and np.intersect1d(used[n], used[m]).size:
+                    clashes[n][m] = clashes[n].get(m, 0) + 1
+                    clashes[m][n] = clashes[m].get(n, 0) + 1
+    assert overused == 0, f"Signal failed to route: {overused} cells overused"
+
+    shorter = groups
+    while shorter:
+        t0 = time.perf_counter()
+        shorter = []
+        for n in groups:
+            layer = nets[n][0]
+            occ = occupied[layer]
+            occ[used[n]] -= 1
+            others = bytearray(np.frombuffer(blocked[layer], np.uint8) | (occ > 0))
+            branches = grid.steiner(others, terminals[n])
+            if sum(map(len, branches)) - len(branches) < used[n].size - 1:
+                routes[n] = branches
+                used[n] = np.unique(np.concatenate(branches))
+                shorter.append(n)
+            occ[used[n]] += 1
+        stats.append((len(groups), 0, time.perf_counter() - t0))
+        if verbose:
+            print(f"Negotiate {len(stats) - 1:2d}: {len(shorter):3d} nets shortened, "
+                  f"{stats[-1][2]:.3f} s")
+    return ([routes.get(n, []) for n in range(len(nets))], stats)
+
+def add_via(blocked, i, clear):
+    # A via at cell i of each occupancy in blocked, with routes kept out
+    # of the cells at offsets clear
+    for b in blocked:
+        b[i] = VIA
+        for o in clear:
+            if not b[i + o]:
+                b[i + o] = CLEAR
+
+def route_in_order(grid, blocked, nets, order, via_cost = None, clear = (), apart = ()):
+    # Route nets one at a time in the given order, pairs by Grid.astar()
+    # as hex_route() does, larger nets by Grid.steiner(). Given via_cost,
+    # pairs route through vias on any layer by Grid.layered(), with clear
+    # and apart as for Grid.sites(). blocked is not changed. Returns the
+    # branches of each net, their cells numbered on the layers of blocked
+    # one after another as for Grid.layered(); None for a net that failed
+    # to route, and the rest are routed anyway.
+    layers = list(blocked)
+    n = grid.size
+    blocked = [bytearray(blocked[layer]) for layer in layers]
+    routes = [None for _ in nets]
+    for m in order:
+        (layer, cells) = nets[m]
+        k = layers.index(layer)
+        if via_cost is not None and len(cells) == 2:
+            sites = grid.sites(blocked, clear, apart)
+            route = grid.layered(bytearray().join(blocked), sites,
+                                 k * n + cells[0], k * n + cells[1], via_cost)
+            branches = None if route is None else [route]
+        else:
+            if len(cells) == 2:
+                route = grid.astar(blocked[k], cells[0], cells[1])
+                branches = None if route is None else [route]
+            else:
+                branches = grid.steiner(blocked[k], cells)
+            if branches is not None:
+                branches = [[k * n + i for i in branch] for branch in branches]
+        if branches is None:
+            continue
+        for branch in branches:
+            for i in branch:
+                blocked[i // n][i % n] = COPPER
+            for (p, i) in zip(branch, branch[1:]):
+                if p % n == i % n:
+                    add_via(blocked, i % n, clear)
+        routes[m] = branches
+    return routes
+
+def score(grid, routes):
+    # (nets failed, vias, steps) of routes from route_in_order(), so the
+    # best routing has the least
+    n = grid.size
+    failed = sum(branches is None for branches in routes)
+    moves = [p % n == i % n for branches in routes if branches
+             for branch in branches for (p, i) in zip(branch, branch[1:])]
+    return (failed, sum(moves), len(moves) - sum(moves))
+
+def orders(grid, nets, k, seed = 0):
+    # k orders in which to route nets: as given, shortest first, longest
+    # first, then shuffled
+    def span(n):
+        (layer, cells) = nets[n]
+        return max(grid.distance(cells[0], c) for c in cells)
+    given = list(range(len(nets)))
+    shortest = sorted(given, key = span)
+    result = [given, shortest, shortest[::-1]]
+    rng = random.Random(seed)
+    while len(result) < k:
+        result.append(rng.sample(given, len(given)))
+    return result[:k]
+
+# The grid, blocked, nets and via settings of a search, shared by each
+# worker process when it starts, so that only the orders go back and forth
+_shared = None
+
+def _share(*snapshot):
+    global _shared
+    _shared = snapshot
+
+def _route(order):
+    (grid, blocked, nets, vias) = _shared
+    routes = route_in_order(grid, blocked, nets, order, *vias)
+    return (score(grid, routes), routes)
+
+def search(grid, blocked, nets, k = 16, workers = None, seed = 0,
+           via_cost = None, clear = (), apart = ()):
+    # Route nets by route_in_order() in each of k orders from orders(),
+    # in workers processes, each starting from the same blocked. Returns
+    # the branches of each net for the best routing by score(), its
+    # score, and for each order (order, score).
+    todo = orders(grid, nets, k, seed)
+    workers = workers or os.cpu_count()
+    snapshot = (grid, blocked, nets, (via_cost, clear, apart))
+    if workers == 1:
+        _share(*snapshot)
+        done = list(map(_route, todo))
+    else:
+        with ProcessPoolExecutor(workers, initializer = _share,
+                                 initargs = snapshot) as ex:
+            done = list(ex.map(_route, todo))
+    (best, routes) = min(done, key = lambda d: d[0])
+    return (routes, best, [(order, sc) for (order, (sc, _)) in zip(todo, done)])
@@ -1,9 +1,14 @@
 """Write a self-contained, interactive 3D board preview."""
 
+import base64
 import hashlib
 import json
+import re
+import zlib
 from pathlib import Path
 
+import numpy as np
+import shapely
 import shapely.geometry as sg
 
 
@@ -15,30 +20,190 @@ _LCD_MESH_MODEL = Path("webviewer/generated/LH133T-IG01.mesh.json")
 _BEZEL_STL_MODEL = Path("assets/misc-stl/bezel.stl")
 _BEZEL_MESH_MODEL = Path("webviewer/generated/bezel.mesh.json")
 _BEZEL_CONTACT_Z = 2.1
+_TRIANGLE_CACHE_DIRECTORY = Path("webviewer/cache/triangles")
+_FILE_CACHE = Path("webviewer/cache/files.json")
+_FILE_CACHE_FORMAT = "cuflow-htmlout-files-1"
+
+
+class _MeshText:
+    """A converted mesh, kept as the compact JSON text of its file."""
+
+    def __init__(self, text):
+        self.text = text
+
+
+def _load_file_cache():
+    path = Path(__file__).parent / _FILE_CACHE
+    try:
+        cache = json.loads(path.read_text())
+    except (OSError, ValueError):
+        return {"format": _FILE_CACHE_FORMAT, "files": {}}
+    if cache.get("format") != _FILE_CACHE_FORMAT:
+        return {"format": _FILE_CACHE_FORMAT, "files": {}}
+    return cache
+
+
+def _save_file_cache(cache):
+    path = Path(__file__).parent / _FILE_CACHE
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(cache, indent=0, sort_keys=True))
+
+
+def _cached(cache, path, compute):
+    """Return ``compute()``, reusing its value while ``path`` is unchanged.
+
+    Files count as unchanged while their size and mtime are.
+    """
+    stat = path.stat()
+    entry = cache["files"].get(str(path))
+    if (
+        entry is not None
+        and entry["size"] == stat.st_size
+        and entry["mtimeNs"] == stat.st_mtime_ns
+    ):
+        return entry["value"]
+    value = compute()
+    cache["files"][str(path)] = {
+        "size": stat.st_size,
+        "mtimeNs": stat.st_mtime_ns,
+        "value": value,
+    }
+    return value
+
+
+def _mesh(mesh_path, source_path, rebuild, cache):
+    """Return the mesh converted from ``source_path``, checking it is current.
+
+    The source hash and the hash the mesh was made from are cached, so an
+    unchanged model is neither hashed nor parsed again.
+    """
+    source_hash = _cached(
+        cache,
+        source_path,
+        lambda: hashlib.sha256(source_path.read_bytes()).hexdigest(),
+    )
+    mesh_hash = _cached(
+        cache,
+        mesh_path,
+        lambda: json.loads(mesh_path.read_text()).get("sourceSha256"),
+    )
+    if mesh_hash != source_hash:
+        raise RuntimeError(f"{mesh_path} is stale; run {rebuild}")
+    return _MeshText(mesh_path.read_text().strip())
+
+
+def _dumps(model):
+    """Return ``model`` as compact JSON, with each _MeshText spliced in."""
+    meshes = []
 
+    def placeholder(value):
+        if not isinstance(value, _MeshText):
+            raise TypeError(f"Cannot serialize {type(value).__name__}")
+        meshes.append(value.text)
+        return f"\0mesh{len(meshes) - 1}"
+
+    text = json.dumps(model, separators=(",", ":"), default=placeholder)
+    return re.sub(
+        r'"\\u0000mesh(\d+)"', lambda match: meshes[int(match[1])], text
+    )
+
+
+def _pack(array):
+    return base64.b64encode(zlib.compress(array.tobytes(), 9)).decode("ascii")
 
-def _ring(coords):
-    points = list(coords)
-    if len(points) > 1 and points[0] == points[-1]:
-        points.pop()
-    return [[round(x, 5), round(y, 5)] for x, y in points]
 
+def _triangles(polygons, coordinates, ring_starts, polygon_starts, used=None):
+    """Return the Uint32 point indices of a triangulation of ``polygons``.
 
-def _polygons(geometry):
+    ``coordinates``, ``ring_starts`` and ``polygon_starts`` are the packed
+    polygons. Triangles are counter-clockwise and cached on disk by a hash
+    of all three, so an unchanged layer is triangulated only once. The
+    name of the cache entry is added to ``used``.
+    """
+    digest = hashlib.sha256(coordinates.tobytes())
+    digest.update(ring_starts.astype("<u4").tobytes())
+    digest.update(polygon_starts.astype("<u4").tobytes())
+    cache_path = (
+        Path(__file__).parent
+        / _TRIANGLE_CACHE_DIRECTORY
+        / f"{digest.hexdigest()}.npy"
+    )
+    if used is not None:
+        used.add(cache_path.name)
+    if cache_path.exists():
+        return np.load(cache_path)
+
+    parts = shapely.get_parts(shapely.constrained_delaunay_triangles(polygons))
+    corners = shapely.get_coordinates(shapely.get_exterior_ring(parts))
+    corners = corners.reshape(-1, 4, 2)[:, :3]
+    # Triangle corners are exact copies of polygon points; map them back
+    unique, inverse = np.unique(
+        np.concatenate([coordinates, corners.reshape(-1, 2)]),
+        axis=0,
+        return_inverse=True,
+    )
+    point_of = np.empty(len(unique), dtype=np.int64)
+    point_of[inverse[: len(coordinates)]] = np.arange(len(coordinates))
+    triangles = point_of[inverse[len(coordinates) :]].reshape(-1, 3)
+    (a, b, c) = (corners[:, 0], corners[:, 1], corners[:, 2])
+    clockwise = (
+        (b[:, 0] - a[:, 0]) * (c[:, 1] - a[:, 1])
+        - (b[:, 1] - a[:, 1]) * (c[:, 0] - a[:, 0])
+    ) < 0
+    triangles[clockwise] = triangles[clockwise][:, ::-1]
+    triangles = triangles.astype("<u4").ravel()
+
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    np.save(cache_path, triangles)
+    return triangles
+
+
+def _prune_triangles(used):
+    """Delete the cached triangulations whose names are not in ``used``."""
+    directory = Path(__file__).parent / _TRIANGLE_CACHE_DIRECTORY
+    for path in directory.glob("*.npy"):
+        if path.name not in used:
+            path.unlink()
+
+
+def _polygons(geometry, origin, triangulate=False, used=None):
+    """Pack the polygons of ``geometry`` as deflated, base64 typed arrays.
+
+    ``points`` holds Float32 x, y pairs relative to ``origin``, without
+    the closing point of each ring. Exteriors are counter-clockwise and
+    holes clockwise. ``rings`` holds the Uint32 index of each ring's
+    first point and ``polygons`` that of each polygon's first ring, its
+    exterior; both end with the total count. With ``triangulate``,
+    ``triangles`` holds the Uint32 point indices of each triangle, and
+    the triangulation's cache entry is added to ``used``.
+    """
     if isinstance(geometry, sg.Polygon):
         geometries = [geometry]
     elif isinstance(geometry, (sg.MultiPolygon, sg.GeometryCollection)):
         geometries = [g for g in geometry.geoms if isinstance(g, sg.Polygon)]
     else:
         raise TypeError(f"Unsupported board geometry: {geometry.geom_type}")
-    return [
-        {
-            "outer": _ring(polygon.exterior.coords),
-            "holes": [_ring(hole.coords) for hole in polygon.interiors],
-        }
-        for polygon in geometries
-        if not polygon.is_empty
-    ]
+    polygons = shapely.orient_polygons(np.array(
+        [polygon for polygon in geometries if not polygon.is_empty],
+        dtype=object,
+    ))
+    rings, owner = shapely.get_rings(polygons, return_index=True)
+    coordinates = shapely.get_coordinates(rings)
+    lengths = shapely.get_num_coordinates(rings) - 1
+    closing = np.cumsum(lengths + 1) - 1
+    coordinates = np.delete(coordinates, closing, axis=0)
+    ring_starts = np.concatenate([[0], np.cumsum(lengths)])
+    polygon_starts = np.searchsorted(owner, np.arange(len(polygons) + 1))
+    layer = {
+        "points": _pack((coordinates - origin).astype("<f4")),
+        "rings": _pack(ring_starts.astype("<u4")),
+        "polygons": _pack(polygon_starts.astype("<u4")),
+    }
+    if triangulate:
+        layer["triangles"] = _pack(
+            _triangles(polygons, coordinates, ring_starts, polygon_starts, used)
+        )
+    return layer
 
 
 def _expand_designators(compact):
@@ -58,7 +223,9 @@ def _expand_designators(compact):
     return designators
 
 
-def _step_library(board, generated_records):
+def _step_library(board, generated_records, cache=None):
+    if cache is None:
+        cache = _load_file_cache()
     root = Path(__file__).parent
     manifest_path = root / _MODEL_MANIFEST
     if not manifest_path.exists():
@@ -122,19 +289,21 @@ def _step_library(board, generated_records):
             raise FileNotFoundError(
                 f"Missing {mesh_path}; run 'npm run convert:models' in webviewer/"
             )
-        mesh = json.loads(mesh_path.read_text())
-        source_hash = hashlib.sha256(step_path.read_bytes()).hexdigest()
-        if mesh.get("sourceSha256") != source_hash:
-            raise RuntimeError(
-                f"{mesh_path} is stale; run 'npm run convert:models' in webviewer/"
-            )
+        mesh = _mesh(
+            mesh_path,
+            step_path,
+            "'npm run convert:models' in webviewer/",
+            cache,
+        )
         models[code] = {"metadata": metadata, "mesh": mesh}
     return models, components, skipped
 
 
 def _anchored_model(
         board, scene_name, source_model, mesh_model, rebuild_command,
-        flip = False, rotation_adjust = 0, flip_offset = None):
+        flip = False, rotation_adjust = 0, flip_offset = None, cache = None):
+    if cache is None:
+        cache = _load_file_cache()
     root = Path(__file__).parent
     source_path = root / source_model
     mesh_path = root / mesh_model
@@ -157,12 +326,7 @@ def _anchored_model(
     if anchor is None:
         raise ValueError(f"Missing model anchor {_LCD_DESIGNATOR}")
 
-    mesh = json.loads(mesh_path.read_text())
-    source_hash = hashlib.sha256(source_path.read_bytes()).hexdigest()
-    if mesh.get("sourceSha256") != source_hash:
-        raise RuntimeError(
-            f"{mesh_path} is stale; run '{rebuild_command}'"
-        )
+    mesh = _mesh(mesh_path, source_path, f"'{rebuild_command}'", cache)
 
     x, y = anchor.center.xy
     return {
@@ -177,17 +341,18 @@ def _anchored_model(
     }
 
 
-def _lcd_model(board):
+def _lcd_model(board, cache=None):
     return _anchored_model(
         board,
         _LCD_DESIGNATOR,
         _LCD_STEP_MODEL,
         _LCD_MESH_MODEL,
         f"node webviewer/convert-step.js {_LCD_STEP_MODEL} {_LCD_MESH_MODEL}",
+        cache = cache,
     )
 
 
-def _bezel_model(board):
+def _bezel_model(board, cache=None):
     return _anchored_model(
         board,
         "LCD bezel",
@@ -197,11 +362,17 @@ def _bezel_model(board):
         flip = True,
         rotation_adjust = 180,
         flip_offset = _BEZEL_CONTACT_Z,
+        cache = cache,
     )
 
 
-def write(board, filename, generated_records, thickness=1.6):
-    """Write ``filename`` without changing any manufacturing layers."""
+def write(board, filename, generated_records, thickness=1.6, triangulate=False):
+    """Write ``filename`` without changing any manufacturing layers.
+
+    With ``triangulate``, the board layers are triangulated here rather
+    than in the browser, which makes dense boards quicker to open. Cached
+    triangulations that this board does not use are then deleted.
+    """
     runtime_path = Path(__file__).with_name("webviewer") / "viewer-runtime.min.js"
     if not runtime_path.exists():
         raise FileNotFoundError(
@@ -225,29 +396,37 @@ def write(board, filename, generated_records, thickness=1.6):
         .intersection(board.layers["GBS"].preview())
         .intersection(body)
     )
-    step_models, components, skipped = _step_library(board, generated_records)
-    lcd_model = _lcd_model(board)
-    bezel_model = _bezel_model(board)
+    cache = _load_file_cache()
+    step_models, components, skipped = _step_library(
+        board, generated_records, cache
+    )
+    lcd_model = _lcd_model(board, cache)
+    bezel_model = _bezel_model(board, cache)
+    _save_file_cache(cache)
     min_x, min_y, max_x, max_y = body.bounds
+    center = ((min_x + max_x) / 2, (min_y + max_y) / 2)
+    used = set()
     model = {
         "name": Path(filename).stem,
         "thickness": thickness,
-        "center": [(min_x + max_x) / 2, (min_y + max_y) / 2],
+        "center": list(center),
         "size": [max_x - min_x, max_y - min_y],
-        "polygons": _polygons(body),
-        "exposedTopCopper": _polygons(exposed_top_copper),
-        "exposedBottomCopper": _polygons(exposed_bottom_copper),
-        "topSilkscreen": _polygons(top_silkscreen),
-        "bottomSilkscreen": _polygons(bottom_silkscreen),
-        "topSolderPaste": _polygons(top_solder_paste),
+        "body": _polygons(body, center, triangulate, used),
+        "exposedTopCopper": _polygons(exposed_top_copper, center, triangulate, used),
+        "exposedBottomCopper": _polygons(exposed_bottom_copper, center, triangulate, used),
+        "topSilkscreen": _polygons(top_silkscreen, center, triangulate, used),
+        "bottomSilkscreen": _polygons(bottom_silkscreen, center, triangulate, used),
+        "topSolderPaste": _polygons(top_solder_paste, center, triangulate, used),
         "stepModels": step_models,
         "lcdModel": lcd_model,
         "bezelModel": bezel_model,
         "components": components,
         "unpopulated": sorted(skipped),
     }
+    if triangulate:
+        _prune_triangles(used)
     runtime = runtime_path.read_text()
-    model_json = json.dumps(model, separators=(",", ":"))
+    model_json = _dumps(model)
     Path(filename).write_text(_document(runtime, model_json))
 
 
@@ -302,7 +481,7 @@ def _document(runtime, model_json):
 <div class="help">Drag to rotate board · right-drag to pan · scroll to zoom</div>
 <script>{runtime}</script>
 <script>
-(() => {{
+(async () => {{
   const MODEL = {model_json};
   const {{ THREE, OrbitControls }} = window.CuflowViewerRuntime;
   const host = document.getElementById("viewer");
@@ -362,48 +541,115 @@ def _document(runtime, model_json):
     side: THREE.DoubleSide
   }});
 
-  function pathFrom(points, PathType) {{
+  function decodeBytes(encoded) {{
+    const binary = atob(encoded);
+    const bytes = new Uint8Array(binary.length);
+    for (let index = 0; index < binary.length; index += 1) {{
+      bytes[index] = binary.charCodeAt(index);
+    }}
+    return bytes;
+  }}
+
+  function decodeTypedArray(encoded, Type) {{
+    return new Type(decodeBytes(encoded).buffer);
+  }}
+
+  async function inflateTypedArray(encoded, Type) {{
+    const stream = new Blob([decodeBytes(encoded)])
+      .stream()
+      .pipeThrough(new DecompressionStream("deflate"));
+    return new Type(await new Response(stream).arrayBuffer());
+  }}
+
+  async function decodeLayer(layer) {{
+    const [points, rings, polygons, triangles] = await Promise.all([
+      inflateTypedArray(layer.points, Float32Array),
+      inflateTypedArray(layer.rings, Uint32Array),
+      inflateTypedArray(layer.polygons, Uint32Array),
+      layer.triangles && inflateTypedArray(layer.triangles, Uint32Array)
+    ]);
+    return {{ points, rings, polygons, triangles }};
+  }}
+
+  // Layer points are already relative to the board center.
+  function pathFrom(layer, ring, PathType) {{
     const path = new PathType();
-    points.forEach(([x, y], index) => {{
-      const px = x - cx;
-      const py = y - cy;
-      if (index === 0) path.moveTo(px, py);
+    const {{ points, rings }} = layer;
+    for (let index = rings[ring]; index < rings[ring + 1]; index += 1) {{
+      const px = points[2 * index];
+      const py = points[2 * index + 1];
+      if (index === rings[ring]) path.moveTo(px, py);
       else path.lineTo(px, py);
-    }});
+    }}
     path.closePath();
     return path;
   }}
 
-  function shapesFrom(polygons) {{
-    return polygons.map((polygon) => {{
-      const shape = pathFrom(polygon.outer, THREE.Shape);
-      polygon.holes.forEach((hole) => shape.holes.push(pathFrom(hole, THREE.Path)));
-      return shape;
-    }});
+  function shapesFrom(layer) {{
+    const shapes = [];
+    for (let polygon = 0; polygon + 1 < layer.polygons.length; polygon += 1) {{
+      const exterior = layer.polygons[polygon];
+      const shape = pathFrom(layer, exterior, THREE.Shape);
+      for (let hole = exterior + 1; hole < layer.polygons[polygon + 1]; hole += 1) {{
+        shape.holes.push(pathFrom(layer, hole, THREE.Path));
+      }}
+      shapes.push(shape);
+    }}
+    return shapes;
   }}
 
-  function extrudedLayer(polygons, depth, y, layerMaterial) {{
-    if (polygons.length === 0) return;
-    const geometry = new THREE.ExtrudeGeometry(shapesFrom(polygons), {{
-      depth,
-      bevelEnabled: false,
-      curveSegments: 1
-    }});
+  // Extrude a layer triangulated by htmlout: the triangles make the top
+  // and bottom faces, and each ring edge a wall of two more.
+  function extrudedTriangles(layer, depth) {{
+    const {{ points, rings, triangles }} = layer;
+    const count = points.length / 2;
+    const positions = new Float32Array(18 * count);
+    const indices = new Uint32Array(2 * triangles.length + 6 * count);
+    for (let index = 0; index < count; index += 1) {{
+      const x = points[2 * index];
+      const y = points[2 * index + 1];
+      positions.set([x, y, depth], 3 * index);
+      positions.set([x, y, 0], 3 * (count + index));
+    }}
+    for (let index = 0; index < triangles.length; index += 3) {{
+      const [a, b, c] = triangles.subarray(index, index + 3);
+      indices.set([a, b, c], index);
+      indices.set([count + a, count + c, count + b], triangles.length + index);
+    }}
+    let vertex = 2 * count;
+    let offset = 2 * triangles.length;
+    for (let ring = 0; ring + 1 < rings.length; ring += 1) {{
+      for (let a = rings[ring]; a < rings[ring + 1]; a += 1) {{
+        const b = a + 1 < rings[ring + 1] ? a + 1 : rings[ring];
+        const [ax, ay] = points.subarray(2 * a, 2 * a + 2);
+        const [bx, by] = points.subarray(2 * b, 2 * b + 2);
+        positions.set([ax, ay, 0, bx, by, 0, bx, by, depth, ax, ay, depth], 3 * vertex);
+        indices.set([vertex, vertex + 1, vertex + 2, vertex, vertex + 2, vertex + 3], offset);
+        vertex += 4;
+        offset += 6;
+      }}
+    }}
+    const geometry = new THREE.BufferGeometry();
+    geometry.setAttribute("position", new THREE.BufferAttribute(positions, 3));
+    geometry.setIndex(new THREE.BufferAttribute(indices, 1));
+    return geometry;
+  }}
+
+  function extrudedLayer(layer, depth, y, layerMaterial) {{
+    if (layer.polygons.length < 2) return;
+    const geometry = layer.triangles
+      ? extrudedTriangles(layer, depth)
+      : new THREE.ExtrudeGeometry(shapesFrom(layer), {{
+        depth,
+        bevelEnabled: false,
+        curveSegments: 1
+      }});
     geometry.rotateX(-Math.PI / 2);
     geometry.translate(0, y, 0);
     geometry.computeVertexNormals();
     group.add(new THREE.Mesh(geometry, layerMaterial));
   }}
 
-  function decodeTypedArray(encoded, Type) {{
-    const binary = atob(encoded);
-    const bytes = new Uint8Array(binary.length);
-    for (let index = 0; index < binary.length; index += 1) {{
-      bytes[index] = binary.charCodeAt(index);
-    }}
-    return new Type(bytes.buffer);
-  }}
-
   const stepMaterialCache = new Map();
   function stepMaterial(rgb) {{
     const key = rgb.join(",");
@@ -533,33 +779,48 @@ def _document(runtime, model_json):
     group.add(accessory);
   }}
 
-  extrudedLayer(MODEL.polygons, MODEL.thickness, -MODEL.thickness / 2, material);
-  extrudedLayer(
+  const [
+    body,
+    exposedTopCopper,
+    exposedBottomCopper,
+    topSolderPaste,
+    topSilkscreen,
+    bottomSilkscreen
+  ] = await Promise.all([
+    MODEL.body,
     MODEL.exposedTopCopper,
+    MODEL.exposedBottomCopper,
+    MODEL.topSolderPaste,
+    MODEL.topSilkscreen,
+    MODEL.bottomSilkscreen
+  ].map(decodeLayer));
+  extrudedLayer(body, MODEL.thickness, -MODEL.thickness / 2, material);
+  extrudedLayer(
+    exposedTopCopper,
     0.012,
     MODEL.thickness / 2 + 0.002,
     exposedGoldMaterial
   );
   extrudedLayer(
-    MODEL.exposedBottomCopper,
+    exposedBottomCopper,
     0.012,
     -MODEL.thickness / 2 - 0.014,
     exposedGoldMaterial
   );
   extrudedLayer(
-    MODEL.topSolderPaste,
+    topSolderPaste,
     0.05,
     MODEL.thickness / 2 + 0.016,
     solderPasteMaterial
   );
   extrudedLayer(
-    MODEL.topSilkscreen,
+    topSilkscreen,
     0.018,
     MODEL.thickness / 2 + 0.006,
     silkscreenMaterial
   );
   extrudedLayer(
-    MODEL.bottomSilkscreen,
+    bottomSilkscreen,
     0.018,
     -MODEL.thickness / 2 - 0.024,
     silkscreenMaterial
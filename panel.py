@@ -0,0 +1,138 @@
+"""Panels: a finished board stepped and repeated on a frame.
+
+Each layer of the board is written once, inside an RS-274X %SR
+step-and-repeat block, and each drill hit once with an Excellon repeat
+code, so a panel costs about the same to write as the board alone.
+The frame adds rails along the bottom and top, tabs with mouse-bites
+joining the boards to each other and to the rails, and fiducials on
+the rails.
+
+    brd = cuflow.Board(...)
+    ...
+    panel.Panel(brd, 4, 6).save("spiq-panel")
+"""
+
+from collections import defaultdict
+
+import shapely
+import shapely.geometry as sg
+import shapely.affinity as sa
+import shapely.ops as so
+
+import gerber
+import pipeline
+from pipeline import Job
+from excellon import excellon
+
+def linestrings(g, lines):
+    # Write lines, a line or collection of lines, to Gerber g
+    lines = shapely.get_parts(shapely.line_merge(lines))
+    (xy, index) = shapely.get_coordinates(lines, return_index = True)
+    g.linestrings(xy, index)
+
+class Panel:
+    def __init__(self, board, nx, ny,
+                 gap = 2.0,         # mm between boards, and boards and rails
+                 rail = 5.0,        # mm, width of the bottom and top rails
+                 tabs = 2,          # on the bottom and top edge of a board
+                 tab = 3.0,         # mm, width of a tab
+                 bite = 0.5,        # mm, mouse-bite hole diameter
+                 bite_pitch = 0.8,  # mm between mouse-bite holes
+                 fiducial = 1.0):   # mm, fiducial diameter
+        self.board = board
+        (self.nx, self.ny) = (nx, ny)
+        self.bite = bite
+        self.fiducial = fiducial
+
+        gml = board.layers['GML']
+        assert gml.lines != [], "Missing board outline"
+        outline = sg.Polygon(gml.lines[-1], gml.lines[:-1])
+        if gml.routed:
+            outline = outline.difference(so.unary_union(gml.routed))
+        (x0, y0, x1, y1) = outline.bounds
+        self.step = (x1 - x0 + gap, y1 - y0 + gap)
+        (px, py) = self.step
+        (bx1, by1) = (x0 + nx * px - gap, y0 + ny * py - gap)
+
+        # A tab runs from the middle of a board across the gaps below and
+        # above it, so it meets any outline shape. Where its ends meet
+        # the next board's tab or a rail, the outline is cut open.
+        # Mouse-bites run across the tab at the edges of the board's box.
+        xs = [x0 + (x1 - x0) * (i + .5) / tabs for i in range(tabs)]
+        strips = [sg.box(x - tab / 2, y0 - gap, x + tab / 2, y1 + gap) for x in xs]
+        e = 1e-4
+        ends = so.unary_union([sg.box(x - tab / 2, y - e, x + tab / 2, y + e)
+                               for x in xs for y in (y0 - gap, y1 + gap)])
+        n = max(1, int(tab / bite_pitch))
+        self.bites = [(x + (k - (n - 1) / 2) * bite_pitch, y)
+                      for x in xs for y in (y0, y1) for k in range(n)]
+
+        # Outline in two parts: one board and its tabs, stepped and
+        # repeated, and the rails
+        piece = so.unary_union([outline] + strips)
+        self.edges = piece.boundary.difference(ends)
+        rails = [sg.box(x0, y0 - gap - rail, bx1, y0 - gap),
+                 sg.box(x0, by1 + gap, bx1, by1 + gap + rail)]
+        self.rails = so.unary_union([r.boundary for r in rails]).difference(
+            so.unary_union(self.copies(ends)))
+
+        (ry0, ry1) = (y0 - gap - rail / 2, by1 + gap + rail / 2)
+        self.fiducials = [(x0 + rail, ry0), (bx1 - rail, ry0), (x0 + rail, ry1)]
+
+    def copies(self, g):
+        # g moved to each board position
+        (px, py) = self.step
+        return [sa.translate(g, i * px, j * py)
+                for j in range(self.ny) for i in range(self.nx)]
+
+    def frame(self, id):
+        # Flashes for the frame on layer id, as (diameter, [xy])
+        d = {
+            'GTL': self.fiducial,
+            'GBL': self.fiducial,
+            'GTS': 2 * self.fiducial,
+            'GBS': 2 * self.fiducial,
+        }.get(id)
+        return (d, self.fiducials if d else [])
+
+    def exports(self, stream = None):
+        # The outputs of save(), as name -> pipeline.Job
+        b = self.board
+        (px, py) = self.step
+        jobs = {}
+        def layer(id, l, extension):
+            def run(basename):
+                with open(basename + "." + extension, "wt") as f:
+                    g = gerber.Gerber(f, l.desc)
+                    if id == 'GML':
+                        g.repeat(self.nx, self.ny, px, py)
+                        linestrings(g, self.edges)
+                        g.repeat()
+                        linestrings(g, self.rails)
+                    else:
+                        g.repeat(self.nx, self.ny, px, py)
+                        # Block apertures are not defined inside the %SR block
+                        l.render(g, stream, blocks = False)
+                        g.repeat()
+                        (d, xys) = self.frame(id)
+                        for xy in xys:
+                            g.circle(xy, d)
+                    g.finish()
+            return run
+        for (id, l) in b.layers.items():
+            extension = b.layer_extensions.get(id, id)
+            jobs[extension] = Job(layer(id, l, extension), (), ("gerber",))
+
+        def drill(basename):
+            holes = defaultdict(list)
+            for (d, xys) in b.holes.items():
+                holes[d] += xys
+            holes[self.bite] += self.bites
+            with open(basename + ".TXT", "wt") as f:
+                excellon(f, holes, (self.nx, self.ny, px, py), b.slots, b.drill_order)
+        jobs["TXT"] = Job(drill, (), ("drill",))
+        return jobs
+
+    def save(self, basename, jobs = 1, only = None, stream = None):
+        # Write the panel's Gerber and drill files, as Board.save does
+        pipeline.run(self.exports(stream), (basename,), only, jobs)
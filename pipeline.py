@@ -0,0 +1,54 @@
+"""Run a table of dependent jobs, optionally on a thread pool.
+
+Board.save() uses this for its outputs. Threads rather than processes,
+because the jobs share the board and its cached geometry, and GEOS
+releases the GIL for the heavy work.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+class Job:
+    def __init__(self, run, deps = (), tags = ()):
+        self.run = run          # called with run()'s args, returns a result
+        self.deps = tuple(deps) # names of jobs that must finish first
+        self.tags = tuple(tags) # group names for selecting jobs
+
+def select(jobs, wanted = None):
+    # Names of the jobs that wanted (job names or tags, None for every
+    # tagged job) needs, in dependency order
+    if wanted is None:
+        roots = [n for (n, j) in jobs.items() if j.tags]
+    else:
+        wanted = set(wanted)
+        roots = [n for (n, j) in jobs.items() if n in wanted or wanted & set(j.tags)]
+        unknown = wanted - set(jobs) - {t for j in jobs.values() for t in j.tags}
+        assert not unknown, "Unknown outputs: " + ", ".join(sorted(unknown))
+    order = []
+    seen = set()
+    def visit(n):
+        if n not in seen:
+            seen.add(n)
+            for d in jobs[n].deps:
+                visit(d)
+            order.append(n)
+    for n in roots:
+        visit(n)
+    return order
+
+def run(jobs, args = (), wanted = None, workers = 1):
+    # Run the selected jobs on args, return their results by name
+    order = select(jobs, wanted)
+    if workers == 1:
+        return {n: jobs[n].run(*args) for n in order}
+
+    # A job is queued after all its dependencies, so by the time a worker
+    # picks it up they are all running or done: waiting cannot deadlock.
+    def after(deps, f):
+        [d.result() for d in deps]
+        return f(*args)
+    futures = {}
+    with ThreadPoolExecutor(workers) as ex:
+        for n in order:
+            deps = [futures[d] for d in jobs[n].deps]
+            futures[n] = ex.submit(after, deps, jobs[n].run)
+        return {n: futures[n].result() for n in order}
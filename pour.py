@@ -0,0 +1,50 @@
+"""Copper pours, cut into tiles and computed on a thread pool.
+
+GEOS releases the GIL under shapely 2, so the tiles pour concurrently
+in plain threads.
+"""
+
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import shapely
+
+tile = 50.0                     # mm, side of a pour tile
+jobs = os.cpu_count() or 1      # worker threads
+big = 100000                    # smaller pours are not worth tiling, in vertices
+
+def grid(bounds, size):
+    # Split bounds into rows of equal tiles no bigger than size
+    (x0, y0, x1, y1) = bounds
+    nx = max(1, math.ceil((x1 - x0) / size))
+    ny = max(1, math.ceil((y1 - y0) / size))
+    xs = np.linspace(x0, x1, nx + 1)
+    ys = np.linspace(y0, y1, ny + 1)
+    return [[(xs[i], ys[j], xs[i + 1], ys[j + 1]) for i in range(nx)]
+            for j in range(ny)]
+
+def pour(area, avoid, r, size = None, workers = None):
+    # Return area.difference(avoid.buffer(r)).
+    # Every point of a tile that is within r of avoid is within r of the
+    # part of avoid inside the tile grown by 2r, so each tile needs only
+    # that part. The stitched tiles are the same geometry as one big pour.
+    # Stitching is serial, so small pours are done in one piece.
+    size = size or tile
+    workers = workers or jobs
+    if (workers == 1 or area.is_empty or
+            shapely.get_num_coordinates(avoid) < big):
+        return area.difference(avoid.buffer(r))
+    rows = grid(area.bounds, size)
+
+    m = 2 * r
+    def work(row):
+        inner = shapely.box(*np.array(row).T)
+        outer = shapely.box(*(np.array(row) + (-m, -m, m, m)).T)
+        a = shapely.intersection(area, inner)
+        b = shapely.buffer(shapely.intersection(avoid, outer), r, quad_segs = 16)
+        return shapely.union_all(shapely.difference(a, b))
+
+    with ThreadPoolExecutor(workers) as ex:
+        return shapely.union_all(list(ex.map(work, rows)))
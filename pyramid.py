@@ -0,0 +1,347 @@
+"""Deep-zoom tile pyramids of board layers, for browsing large boards.
+
+The layers are drawn by raster into an XYZ pyramid of PNG tiles,
+z/x/y.png with y = 0 at the top. Level 0 fits the board in one tile,
+and each level doubles the resolution, up to ``ppmm`` pixels per mm.
+A tile's name in tiles.json is a hash of the edges that reach it, so
+re-exporting after a change redraws only the tiles it touched. Tiles
+with nothing on them are not written.
+
+    python pyramid.py dazzler dazzler-tiles        # write every tile
+    python pyramid.py dazzler dazzler-tiles --serve 8000
+
+The second draws tiles only as the viewer asks for them. Either way
+index.html in the directory is a small viewer that pans (drag) and
+zooms (wheel), loading just the tiles in view.
+"""
+
+import argparse
+import hashlib
+import http.server
+import json
+import math
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import numpy as np
+import shapely
+from PIL import Image
+
+import raster
+
+def linear(g):
+    # Whether g, geometry or (geometry, dark) objects, has lines or points
+    if isinstance(g, list) and g and isinstance(g[0], tuple):
+        g = [o for (o, _) in g]
+    parts = shapely.get_parts(np.atleast_1d(np.asarray(g, dtype = object)))
+    return bool((shapely.get_type_id(parts) != shapely.GeometryType.POLYGON).any())
+
+def stale(dirname, current):
+    # Names of the z/x/y.png tiles in dirname not in current
+    names = []
+    for (path, dirs, files) in os.walk(dirname):
+        rel = os.path.relpath(path, dirname).split(os.sep)
+        if len(rel) == 2 and all(v.isdigit() for v in rel):
+            names += ["/".join(rel + [f]) for f in files
+                      if f.endswith(".png") and f[:-4].isdigit()]
+    return sorted(n for n in names if n not in current)
+
+class Pyramid:
+    def __init__(self, layers, bounds = None, ppmm = 20, size = 256,
+                 background = (0, 0, 0)):
+        # layers as for raster.render(): (geometry, colour), bottom first
+        self.layers = layers
+        self.size = size
+        self.background = background
+        # Polygon edges are the same at every level, so are prepared once.
+        # Lines are drawn a pixel wide, so differ from level to level.
+        self.fine = raster.prepare(layers, ppmm)
+        self.linear = [linear(g) for (g, _) in layers]
+        self.bounds = bounds or raster.bounds_of(self.fine)
+        (x0, y0, x1, y1) = self.bounds
+        self.ppmm0 = size / max(x1 - x0, y1 - y0, 1e-3)
+        self.levels = 1 + max(0, math.ceil(math.log2(ppmm / self.ppmm0)))
+        self.prepared = {}
+        self.lock = threading.Lock()
+
+    def ppmm(self, z):
+        return self.ppmm0 * 2 ** z
+
+    def tiles(self, z):
+        # Number of tiles across and down at level z
+        (h, w) = raster.grid(self.bounds, self.ppmm(z))
+        return (-(-w // self.size), -(-h // self.size))
+
+    def level(self, z):
+        # The layers prepared for level z, made when first needed
+        with self.lock:
+            if z not in self.prepared:
+                self.prepared[z] = [
+                    raster.prepare([l], self.ppmm(z))[0] if lin else f
+                    for (l, f, lin) in zip(self.layers, self.fine, self.linear)]
+            return self.prepared[z]
+
+    def clip(self, z, x, y, parent = None):
+        # The layers clipped to tile z/x/y. parent, the layers clipped to
+        # the tile's parent, holds all the polygon edges that can reach
+        # it, so is much quicker to clip than the whole level.
+        s = self.size
+        win = (y * s, (y + 1) * s, x * s, (x + 1) * s)
+        layers = self.level(z)
+        if parent is not None:
+            layers = [l if lin else p for (l, p, lin) in zip(layers, parent, self.linear)]
+        return raster.clip(layers, self.bounds, self.ppmm(z), win)
+
+    def key(self, clipped, z, x, y):
+        # Hash of tile z/x/y from its clipped layers, None if it is empty
+        if not any(rs for (rs, _) in clipped):
+            return None
+        s = self.size
+        win = (y * s, (y + 1) * s, x * s, (x + 1) * s)
+        h = hashlib.sha1(repr((self.ppmm(z), win, self.bounds, self.background)).encode())
+        for (rs, colour) in clipped:
+            h.update(repr((colour, [dark for (_, dark, _) in rs])).encode())
+            for (e, _, _) in rs:
+                h.update(e.tobytes())
+        return h.hexdigest()
+
+    def png(self, clipped, z, x, y):
+        # The PNG of tile z/x/y, as bytes
+        s = self.size
+        win = (y * s, (y + 1) * s, x * s, (x + 1) * s)
+        rgb = raster.tile(clipped, self.bounds, self.ppmm(z), win, self.background, clipped = True)
+        f = BytesIO()
+        Image.fromarray(rgb).save(f, "PNG")
+        return f.getvalue()
+
+    def meta(self):
+        (x0, y0, x1, y1) = self.bounds
+        return {
+            "size": self.size,
+            "levels": self.levels,
+            "ppmm0": self.ppmm0,
+            "bounds": [x0, y0, x1, y1],
+            "tiles": [self.tiles(z) for z in range(self.levels)],
+            "background": "rgb(%d,%d,%d)" % self.background,
+        }
+
+    def viewer(self, dirname):
+        with open(os.path.join(dirname, "index.html"), "wt") as f:
+            f.write(viewer.replace("{META}", json.dumps(self.meta())))
+
+    def export(self, dirname, workers = 1):
+        # Write the pyramid and its viewer to dirname, skipping tiles
+        # whose content is unchanged since the last export there.
+        # Returns the number of tiles drawn.
+        index = os.path.join(dirname, "tiles.json")
+        try:
+            with open(index) as f:
+                old = json.load(f)
+        except (OSError, ValueError):
+            old = {}
+        new = {}
+        os.makedirs(dirname, exist_ok = True)
+        def one(job):
+            # Draw tile z/x/y if it changed; return its clipped layers
+            ((z, x, y), parent) = job
+            name = "%d/%d/%d.png" % (z, x, y)
+            fn = os.path.join(dirname, name)
+            clipped = self.clip(z, x, y, parent)
+            h = self.key(clipped, z, x, y)
+            if h is None:
+                if os.path.exists(fn):
+                    os.remove(fn)
+                return (clipped, 0)
+            new[name] = h
+            if old.get(name) == h and os.path.exists(fn):
+                return (clipped, 0)
+            os.makedirs(os.path.dirname(fn), exist_ok = True)
+            with open(fn, "wb") as f:
+                f.write(self.png(clipped, z, x, y))
+            return (clipped, 1)
+        # A level at a time, each tile clipped from its parent
+        drawn = 0
+        parents = {(0, 0): None}
+        with ThreadPoolExecutor(workers) as ex:
+            for z in range(self.levels):
+                (nx, ny) = self.tiles(z)
+                tiles = [(x, y) for x in range(nx) for y in range(ny)]
+                jobs = [((z, x, y), parents[(x // 2, y // 2)] if z else None)
+                        for (x, y) in tiles]
+                done = list(ex.map(one, jobs))
+                drawn += sum(n for (_, n) in done)
+                parents = {xy: c for (xy, (c, _)) in zip(tiles, done)}
+        # Tiles of an earlier, larger pyramid would still be served
+        for name in stale(dirname, new):
+            os.remove(os.path.join(dirname, name))
+        with open(index, "wt") as f:
+            json.dump(new, f, sort_keys = True, indent = 0)
+        self.viewer(dirname)
+        return drawn
+
+    def serve(self, dirname, port = 8000):
+        # Serve the viewer from dirname, drawing each tile when it is
+        # first asked for. A tile already on disk is served only if its
+        # hash in tiles.json matches the board's; otherwise it is redrawn.
+        os.makedirs(dirname, exist_ok = True)
+        self.viewer(dirname)
+        index = os.path.join(dirname, "tiles.json")
+        try:
+            with open(index) as f:
+                known = json.load(f)
+        except (OSError, ValueError):
+            known = {}
+        checked = set()         # tiles known to be current
+        lock = threading.Lock()
+        pyramid = self
+        def tile(z, x, y):
+            # Make sure tile z/x/y on disk is current; False if it is empty
+            name = "%d/%d/%d.png" % (z, x, y)
+            fn = os.path.join(dirname, name)
+            if name in checked:
+                return os.path.exists(fn)
+            clipped = pyramid.clip(z, x, y)
+            h = pyramid.key(clipped, z, x, y)
+            with lock:
+                if h is None:
+                    if os.path.exists(fn):
+                        os.remove(fn)
+                elif known.get(name) != h or not os.path.exists(fn):
+                    os.makedirs(os.path.dirname(fn), exist_ok = True)
+                    with open(fn, "wb") as f:
+                        f.write(pyramid.png(clipped, z, x, y))
+                if known.get(name) != h:
+                    if h is None:
+                        del known[name]
+                    else:
+                        known[name] = h
+                    with open(index, "wt") as f:
+                        json.dump(known, f, sort_keys = True, indent = 0)
+                checked.add(name)
+            return h is not None
+        class Handler(http.server.SimpleHTTPRequestHandler):
+            def __init__(self, *args, **kw):
+                super().__init__(*args, directory = dirname, **kw)
+            def do_GET(self):
+                p = self.path.strip("/").split("/")
+                if len(p) == 3 and p[2].endswith(".png") and all(
+                        v.isdigit() for v in p[:2] + [p[2][:-4]]):
+                    (z, x, y) = (int(p[0]), int(p[1]), int(p[2][:-4]))
+                    if z >= pyramid.levels or not tile(z, x, y):
+                        return self.send_error(404)
+                return super().do_GET()
+        server = http.server.ThreadingHTTPServer(("", port), Handler)
+        print("Serving on http://localhost:%d/" % port)
+        server.serve_forever()
+
+viewer = """\
+<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Board</title>
+<style>
+html, body { margin: 0; height: 100%; overflow: hidden; background: #000; }
+canvas { display: block; cursor: grab; }
+</style>
+</head>
+<body>
+<canvas id="c"></canvas>
+<script>
+const meta = {META};
+const canvas = document.getElementById("c");
+const ctx = canvas.getContext("2d");
+const cache = new Map();        // "z/x/y" -> Image, or null if empty
+let scale, ox, oy;              // screen px per level 0 px, and offset
+
+function fit() {
+  canvas.width = innerWidth;
+  canvas.height = innerHeight;
+  const [w, h] = meta.tiles[0].map(n => n * meta.size);
+  scale = Math.min(canvas.width / w, canvas.height / h) * 0.95;
+  ox = (canvas.width - w * scale) / 2;
+  oy = (canvas.height - h * scale) / 2;
+}
+
+function image(z, x, y) {
+  const k = z + "/" + x + "/" + y;
+  if (!cache.has(k)) {
+    const im = new Image();
+    cache.set(k, im);
+    im.onload = draw;
+    im.onerror = () => cache.set(k, null);
+    im.src = k + ".png";
+  }
+  return cache.get(k);
+}
+
+function tile(z, x, y, sx, sy, s) {
+  // Draw tile z/x/y at screen sx, sy, s px square; while it loads, draw
+  // the part of its parent that covers it
+  const im = image(z, x, y);
+  if (im === null) return;
+  if (im.complete && im.naturalWidth) {
+    ctx.drawImage(im, sx, sy, s, s);
+  } else {
+    for (let p = 1; p <= z; p++) {
+      const f = 1 << p;
+      const pim = cache.get((z - p) + "/" + (x >> p) + "/" + (y >> p));
+      if (pim && pim.complete && pim.naturalWidth) {
+        const q = meta.size / f;
+        ctx.drawImage(pim, (x % f) * q, (y % f) * q, q, q, sx, sy, s, s);
+        return;
+      }
+    }
+  }
+}
+
+function draw() {
+  ctx.fillStyle = meta.background;
+  ctx.fillRect(0, 0, canvas.width, canvas.height);
+  const z = Math.max(0, Math.min(meta.levels - 1, Math.ceil(Math.log2(scale * devicePixelRatio))));
+  const s = meta.size * scale / (1 << z);
+  const [nx, ny] = meta.tiles[z];
+  const x0 = Math.max(0, Math.floor(-ox / s)), x1 = Math.min(nx, Math.ceil((canvas.width - ox) / s));
+  const y0 = Math.max(0, Math.floor(-oy / s)), y1 = Math.min(ny, Math.ceil((canvas.height - oy) / s));
+  for (let y = y0; y < y1; y++)
+    for (let x = x0; x < x1; x++)
+      tile(z, x, y, ox + x * s, oy + y * s, s + 0.5);
+}
+
+let drag = null;
+canvas.onmousedown = e => { drag = [e.clientX - ox, e.clientY - oy]; };
+onmouseup = () => { drag = null; };
+onmousemove = e => {
+  if (drag) { ox = e.clientX - drag[0]; oy = e.clientY - drag[1]; draw(); }
+};
+canvas.onwheel = e => {
+  e.preventDefault();
+  const f = Math.exp(-e.deltaY * 0.002);
+  ox = e.clientX - (e.clientX - ox) * f;
+  oy = e.clientY - (e.clientY - oy) * f;
+  scale *= f;
+  draw();
+};
+onresize = () => { fit(); draw(); };
+fit();
+draw();
+</script>
+</body>
+</html>
+"""
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description = "Deep-zoom tiles of a board's Gerber files")
+    p.add_argument("basename")
+    p.add_argument("dirname")
+    p.add_argument("--ppmm", type = float, default = 20, help = "pixels per mm at the deepest level")
+    p.add_argument("--workers", type = int, default = os.cpu_count())
+    p.add_argument("--serve", type = int, metavar = "PORT", help = "draw tiles on demand")
+    args = p.parse_args()
+    pyr = Pyramid(raster.gerbers(args.basename, args.ppmm), ppmm = args.ppmm)
+    if args.serve:
+        pyr.serve(args.dirname, args.serve)
+    else:
+        print("%d tiles drawn" % pyr.export(args.dirname, args.workers))
@@ -0,0 +1,290 @@
+"""Rasterize Shapely geometry into NumPy masks.
+
+Polygons are filled by scanline with the nonzero winding rule, all of
+them at once: every edge's crossings with the pixel rows are found in
+one vectorized pass, and a running sum along each row gives the
+winding number. Overlapping polygons need not be unioned first, so a
+whole layer, or a batch of Gerber objects of one polarity, costs one
+pass. Large images are filled a band of rows at a time.
+
+    mask = raster.rasterize(polys, bounds, ppmm = 25)
+
+render() draws several layers in colour, a tile at a time:
+
+    raster.save("board.png", [(copper, (160, 160, 0)), (silk, (255, 255, 255))])
+"""
+
+import os
+import sys
+
+import numpy as np
+import shapely
+from PIL import Image
+
+import gerber_loader
+
+def polygons(geoms, width = 0):
+    # The polygons in geoms, a geometry or a sequence of them, with
+    # exteriors counterclockwise and holes clockwise. Lines and points
+    # are dropped, or with width set, drawn that wide.
+    parts = shapely.get_parts(np.atleast_1d(np.asarray(geoms, dtype = object)))
+    areal = shapely.get_type_id(parts) == shapely.GeometryType.POLYGON
+    if width:
+        parts = np.concatenate([parts[areal], shapely.get_parts(
+            shapely.buffer(parts[~areal], width / 2, quad_segs = 2))])
+    else:
+        parts = parts[areal]
+    return shapely.orient_polygons(parts)
+
+def edges(geoms, width = 0):
+    # All the ring edges of geoms as an array of (x0, y0, x1, y1)
+    rings = shapely.get_rings(polygons(geoms, width))
+    (xy, index) = shapely.get_coordinates(rings, return_index = True)
+    same = index[1:] == index[:-1]
+    return np.hstack([xy[:-1], xy[1:]])[same]
+
+def grid(bounds, ppmm):
+    # Size in pixels of bounds at ppmm pixels per mm
+    (x0, y0, x1, y1) = bounds
+    return (max(1, int(np.ceil((y1 - y0) * ppmm))),
+            max(1, int(np.ceil((x1 - x0) * ppmm))))
+
+def window(e, bounds, ppmm):
+    # Rows and columns (r0, r1, c0, c1) of grid(bounds, ppmm) that the
+    # edges e can touch
+    (h, w) = grid(bounds, ppmm)
+    (x0, _, _, y1) = bounds
+    if len(e) == 0:
+        return (0, 0, 0, 0)
+    xs = (e[:, [0, 2]] - x0) * ppmm
+    ys = (y1 - e[:, [1, 3]]) * ppmm
+    clip = lambda v, n: int(min(max(v, 0), n))
+    return (clip(np.floor(ys.min()), h), clip(np.ceil(ys.max()) + 1, h),
+            clip(np.floor(xs.min()), w), clip(np.ceil(xs.max()) + 1, w))
+
+def fill(e, bounds, ppmm, band = 1024, win = None):
+    # Fill the edges e, from edges(), into a mask of grid(bounds, ppmm).
+    # Row 0 is the top of bounds. A pixel is set if its center is inside.
+    # If win is (r0, r1, c0, c1), fill only those rows and columns.
+    (h, w) = grid(bounds, ppmm)
+    (r0, r1, c0, c1) = win or (0, h, 0, w)
+    (h, w) = (r1 - r0, c1 - c0)
+    (x0, _, _, y1) = bounds
+    mask = np.zeros((h, w), bool)
+    if len(e) == 0 or h == 0 or w == 0:
+        return mask
+    # To pixel units in the window, y downward; then drop horizontal edges
+    px = (e[:, [0, 2]] - x0) * ppmm - c0
+    py = (y1 - e[:, [1, 3]]) * ppmm - r0
+    keep = py[:, 0] != py[:, 1]
+    (px, py) = (px[keep], py[keep])
+    wind = np.where(py[:, 1] > py[:, 0], 1, -1)
+    lo = np.minimum(py[:, 0], py[:, 1])
+    hi = np.maximum(py[:, 0], py[:, 1])
+    # Each edge crosses the row centers r + .5 with first <= r < last
+    first = np.clip(np.ceil(lo - .5), 0, h).astype(np.int64)
+    last = np.clip(np.ceil(hi - .5), 0, h).astype(np.int64)
+    slope = (px[:, 1] - px[:, 0]) / (py[:, 1] - py[:, 0])
+    for r0 in range(0, h, band):
+        r1 = min(h, r0 + band)
+        s = np.flatnonzero((first < r1) & (last > r0))
+        a = np.maximum(first[s], r0)
+        n = np.minimum(last[s], r1) - a
+        s = np.repeat(s, n)
+        # Row of each crossing: a, a + 1, ... for each edge
+        start = np.repeat(np.cumsum(n) - n, n)
+        row = np.repeat(a, n) + np.arange(len(s)) - start
+        x = px[s, 0] + (row + .5 - py[s, 0]) * slope[s]
+        col = np.clip(np.ceil(x - .5), 0, w).astype(np.int64)
+        acc = np.bincount((row - r0) * (w + 1) + col, weights = wind[s],
+                          minlength = (r1 - r0) * (w + 1))
+        winding = np.cumsum(acc.reshape(r1 - r0, w + 1)[:, :w], axis = 1)
+        mask[r0:r1] = winding != 0
+    return mask
+
+def rasterize(geoms, bounds, ppmm = 25, band = 1024):
+    # Mask of the polygons in geoms over bounds, at ppmm pixels per mm
+    return fill(edges(geoms), bounds, ppmm, band)
+
+def runs(objects):
+    # Group (geometry, dark) objects into runs of one polarity, as
+    # ([geometry], dark)
+    i = 0
+    while i < len(objects):
+        dark = objects[i][1]
+        j = i
+        while j < len(objects) and objects[j][1] == dark:
+            j += 1
+        yield ([g for (g, _) in objects[i:j]], dark)
+        i = j
+
+def paint(objects, bounds, ppmm = 25, band = 1024):
+    # Mask of (geometry, dark) objects drawn in order, as from
+    # gerber_loader.load_objects(). Each run of one polarity is filled
+    # in one pass.
+    mask = np.zeros(grid(bounds, ppmm), bool)
+    for (geoms, dark) in runs(objects):
+        # Only the pixels under the run are filled
+        e = edges(geoms)
+        (r0, r1, c0, c1) = win = window(e, bounds, ppmm)
+        m = fill(e, bounds, ppmm, band, win)
+        if dark:
+            mask[r0:r1, c0:c1] |= m
+        else:
+            mask[r0:r1, c0:c1] &= ~m
+    return mask
+
+# Colours of the layers, and the order they are drawn in, bottom first
+colours = {
+    'GBO': (0x50, 0x50, 0x50),
+    'GBL': (0x00, 0x80, 0x00),
+    'GL3': (0x00, 0xff, 0xff),
+    'G3L': (0x00, 0xff, 0xff),
+    'GL2': (0xff, 0xff, 0x00),
+    'G2L': (0xff, 0xff, 0x00),
+    'GTL': (0xa0, 0xa0, 0x00),
+    'GTO': (0xff, 0xff, 0xff),
+    'TXT': (0xff, 0x00, 0x00),
+    'GML': (0xff, 0x20, 0x00),
+}
+
+def prepare(layers, ppmm):
+    # layers is a sequence of (geometry, colour), bottom first. geometry
+    # can also be a list of (geometry, dark) objects, as from
+    # gerber_loader.load_objects(). Returns a list of runs
+    # [(edges, dark, bounds)] and the colour for each, with lines and
+    # points drawn a pixel wide.
+    def objects(g):
+        if isinstance(g, list) and g and isinstance(g[0], tuple):
+            return runs(g)
+        return [(g, True)]
+    def run(g, dark):
+        e = edges(g, 1 / ppmm)
+        if len(e) == 0:
+            return (e, dark, (0, 0, 0, 0))
+        return (e, dark, (e[:, [0, 2]].min(), e[:, [1, 3]].min(),
+                          e[:, [0, 2]].max(), e[:, [1, 3]].max()))
+    return [([run(g, dark) for (g, dark) in objects(g)], c)
+            for (g, c) in layers]
+
+def bounds_of(layers):
+    # Bounds of the prepared layers
+    b = np.array([b for (rs, _) in layers for (e, _, b) in rs if len(e)] or [(0, 0, 0, 0)])
+    return (float(b[:, 0].min()), float(b[:, 1].min()),
+            float(b[:, 2].max()), float(b[:, 3].max()))
+
+def collapse(e, xa):
+    # The edges e, with those wholly left of x = xa replaced by vertical
+    # edges on it that cross each row the same net number of times.
+    # Usually they cancel out, leaving few or none.
+    left = np.maximum(e[:, 0], e[:, 2]) < xa
+    if not left.any():
+        return e
+    l = e[left]
+    d = np.sign(l[:, 3] - l[:, 1])
+    ys = np.concatenate([np.minimum(l[:, 1], l[:, 3]), np.maximum(l[:, 1], l[:, 3])])
+    order = np.argsort(ys, kind = "stable")
+    ys = ys[order]
+    # level[k] is the net crossing count between ys[k] and ys[k + 1]
+    level = np.cumsum(np.concatenate([d, -d])[order])[:-1]
+    n = np.where(ys[1:] > ys[:-1], np.abs(level), 0).astype(np.int64)
+    k = np.repeat(np.arange(len(n)), n)
+    up = level[k] > 0
+    (a, b) = (ys[k], ys[k + 1])
+    x = np.full(len(k), xa)
+    v = np.column_stack([x, np.where(up, a, b), x, np.where(up, b, a)])
+    return np.vstack([e[~left], v])
+
+def clip(layers, bounds, ppmm, win):
+    # The prepared layers, keeping only the edges that matter to the
+    # window win = (r0, r1, c0, c1) of grid(bounds, ppmm)
+    (r0, r1, c0, c1) = win
+    (x0, _, _, y1) = bounds
+    # Only edges spanning some of the window's rows, and not wholly right
+    # of it, cross its pixel rows to the left of a pixel. Those wholly to
+    # the left only matter through their net crossings, so are collapsed;
+    # a run wholly to the left crosses each row as often each way, so is
+    # dropped.
+    (ya, yb) = (y1 - r1 / ppmm, y1 - r0 / ppmm)
+    (xa, xb) = (x0 + c0 / ppmm, x0 + c1 / ppmm)
+    def runs(rs):
+        for (e, dark, b) in rs:
+            (bx0, by0, bx1, by1) = b
+            if by0 > yb or by1 < ya or bx0 > xb or bx1 < xa:
+                continue
+            e = collapse(e[(np.minimum(e[:, 1], e[:, 3]) <= yb) &
+                           (np.maximum(e[:, 1], e[:, 3]) >= ya) &
+                           (np.minimum(e[:, 0], e[:, 2]) <= xb)], xa)
+            if len(e):
+                yield (e, dark, b)
+    return [(list(runs(rs)), c) for (rs, c) in layers]
+
+def tile(layers, bounds, ppmm, win, background = (0, 0, 0), clipped = False):
+    # RGB of the window win = (r0, r1, c0, c1) of grid(bounds, ppmm),
+    # drawing the prepared layers in order. clipped says they are
+    # already clip()ped to win.
+    (r0, r1, c0, c1) = win
+    # Each pixel's index in palette, the background then the layers
+    palette = np.array([background] + [c for (_, c) in layers], np.uint8)
+    top = np.zeros((r1 - r0, c1 - c0), np.uint8)
+    if not clipped:
+        layers = clip(layers, bounds, ppmm, win)
+    for (i, (rs, _)) in enumerate(layers, 1):
+        mask = np.zeros(top.shape, bool)
+        for (e, dark, _) in rs:
+            # Fill only the rows of the window the run crosses, from its
+            # leftmost edge. Edges to the right may have been clipped, so
+            # the fill can reach the right of the window.
+            (a0, a1, b0, _) = window(e, bounds, ppmm)
+            (a0, a1, b0, b1) = (max(a0, r0), min(a1, r1), max(b0, c0), c1)
+            if a0 >= a1 or b0 >= b1:
+                continue
+            m = fill(e, bounds, ppmm, win = (a0, a1, b0, b1))
+            sub = mask[a0 - r0:a1 - r0, b0 - c0:b1 - c0]
+            if dark:
+                sub |= m
+            else:
+                sub &= ~m
+        top[mask] = i
+    return palette[top]
+
+def render(layers, bounds = None, ppmm = 25, size = 1024, background = (0, 0, 0)):
+    # RGB image of layers, a sequence of (geometry, colour) drawn bottom
+    # first, at ppmm pixels per mm. Filled size pixels square at a time,
+    # so working memory stays small however big the image.
+    layers = prepare(layers, ppmm)
+    bounds = bounds or bounds_of(layers)
+    (h, w) = grid(bounds, ppmm)
+    rgb = np.empty((h, w, 3), np.uint8)
+    for r in range(0, h, size):
+        # The tiles of a row need only the edges of that row
+        row = clip(layers, bounds, ppmm, (r, min(h, r + size), 0, w))
+        for c in range(0, w, size):
+            win = (r, min(h, r + size), c, min(w, c + size))
+            rgb[win[0]:win[1], win[2]:win[3]] = tile(row, bounds, ppmm, win, background)
+    return rgb
+
+def save(filename, layers, bounds = None, ppmm = 25, **kw):
+    # Render layers, as for render(), to an image file such as a PNG
+    Image.fromarray(render(layers, bounds, ppmm, **kw)).save(filename)
+
+def gerbers(basename, ppmm = 25, names = None):
+    # Layers of a board's Gerber and drill files, for render(). ppmm is
+    # the finest resolution they will be drawn at.
+    names = names or [n for n in colours if os.path.exists(basename + "." + n)]
+    def load(n):
+        fn = basename + "." + n
+        if n == 'TXT':
+            return gerber_loader.load(fn)
+        objects = gerber_loader.load_objects(fn, .25 / ppmm)
+        if n == 'GML':
+            # Outlines are hairlines; as lines they are drawn a pixel wide
+            objects = [(g.boundary.simplify(.25 / ppmm), d) for (g, d) in objects]
+        return objects
+    return [(load(n), colours[n]) for n in names]
+
+if __name__ == "__main__":
+    # raster.py basename [ppmm]: a PNG of the board, as the view script
+    # shows it
+    (basename, ppmm) = (sys.argv[1], float(sys.argv[2]) if len(sys.argv) > 2 else 25)
+    save(basename + ".png", gerbers(basename, ppmm), ppmm = ppmm)
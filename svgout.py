@@ -1,16 +1,13 @@
 import shapely.geometry as sg
 import shapely.affinity as sa
-import shapely.ops as so
 import svgwrite
 
 def write(board, filename, style = 'laser'):
     gml = board.layers['GML'].lines
     block = sg.Polygon(gml[-1], gml[:-1])
     block = block.buffer(1).buffer(-1)
-    for d,xys in board.holes.items():
-        if d > 0.3:
-            hlist = so.unary_union([sg.Point(xy).buffer(d / 2) for xy in xys])
-            block = block.difference(hlist)
+    for hlist in board.cutouts():
+        block = block.difference(hlist)
 
     block = sa.scale(block, 1, -1, origin = (0,0))  # flip Y for svg
     (x0, y0, x1, y1) = block.bounds
@@ -32,18 +29,10 @@ def write(board, filename, style = 'laser'):
         if type(po) == sg.MultiPolygon:
             [renderpoly(p, args) for p in po.geoms]
             return
-        # Subdivide a poly if it has holes
-        if len(po.interiors) == 0:
-            dwg.add(dwg.polygon(po.exterior.coords, **args))
-        else:
-            x0 = min([x for (x, y) in po.exterior.coords])
-            x1 = max([x for (x, y) in po.exterior.coords])
-            y0 = min([y for (x, y) in po.exterior.coords])
-            y1 = max([y for (x, y) in po.exterior.coords])
-            xm = (x0 + x1) / 2
-            eps = 0.00
-            renderpoly(po.intersection(sg.box(x0, y0, xm + eps, y1)), args)
-            renderpoly(po.intersection(sg.box(xm - eps, y0, x1, y1)), args)
+        # One path per poly, holes are subpaths
+        d = ["M" + " L".join(["%f,%f" % xy for xy in l.coords]) + " Z"
+             for l in [po.exterior] + list(po.interiors)]
+        dwg.add(dwg.path(d = " ".join(d), fill_rule = 'evenodd', **args))
 
     if 0:
         args = {'stroke':'blue', 'fill_opacity':0.0, 'stroke_width':.1}
@@ -1,15 +1,12 @@
 import shapely.geometry as sg
 import shapely.affinity as sa
-import shapely.ops as so
 
 def write(board, filename):
     gml = board.layers['GML'].lines
     block = sg.Polygon(gml[-1], gml[:-1])
     block = block.buffer(1).buffer(-1)
-    for d,xys in board.holes.items():
-        if d > 0.3:
-            hlist = so.unary_union([sg.Point(xy).buffer(d / 2) for xy in xys])
-            block = block.difference(hlist)
+    for hlist in board.cutouts():
+        block = block.difference(hlist)
 
     (x0, y0, x1, y1) = block.bounds
     block = sa.translate(block, -x0, -y0)